@@ -2,6 +2,8 @@
 This module contains the command line interface.
 """
 import argparse
+import contextlib
+import concurrent.futures
 import time
 import os
 import sys
@@ -9,25 +11,16 @@ import sys
 
 try:
     import multiprocessing
-    multiprocessing.set_start_method("forkserver")
-except Exception:
+except ImportError:
     # multiprocessing may not be available
     multiprocessing = None
 
-from sqlalchemy.orm import Session
-
-from .db.models import Base
-from .db.connection import ConnectionConfig
-from .importer import import_posts_from_file, import_comments_from_file, prepare_db
-from .zimbuild.builder import ZimBuilder, BuildOptions
-from .downloader import download_all as download_all_media
-from .downloader import check_all as check_all_media
-from .downloader import delete_all as delete_all_media
-from .imgutils import check_ffmpeg
-from .fetcher import fetch_all
-from .retriever import retrieve_posts, retrieve_comments
+from .zimbuild.options import BuildOptions
 from .util import format_timedelta
-from .jsonl import write_jsonl
+
+
+# commands that start worker processes and need the "forkserver" start method
+MULTIPROCESSING_COMMANDS = ("import", "download-media", "build")
 
 
 def _connection_config_from_ns(ns):
@@ -39,9 +32,12 @@ def _connection_config_from_ns(ns):
     @return: the connection config
     @rtype: L{arcticzim.db.connection.ConnectionConfig}
     """
+    from .db.connection import ConnectionConfig
+
     config = ConnectionConfig(
         url=ns.database,
         verbose=(ns.verbose >= 2),
+        insert_page_size=getattr(ns, "insert_page_size", None),
     )
     return config
 
@@ -53,6 +49,9 @@ def run_retrieve(ns):
     @param ns: namespace containing arguments
     @type ns: L{argparse.Namespace}
     """
+    from .retriever import retrieve_posts, retrieve_comments
+    from .jsonl import write_jsonl
+
     if (ns.author is None) == (ns.subreddit is None):
         print("Error: exactly one of author or subreddit needs to be specified!")
         sys.exit(1)
@@ -82,28 +81,75 @@ def run_import(ns):
     @param ns: namespace containing arguments
     @type ns: L{argparse.Namespace}
     """
+    from sqlalchemy.orm import Session
+
+    from .db.connection import init_schema
+    from .importer import import_posts_from_file, import_comments_from_iterable, prepare_db, read_jsonl
+    from .importer import COMMENT_IMPORT_KEYS
+
     start = time.time()
     print("Connecting to database...")
     engine = _connection_config_from_ns(ns).connect()
     print("Database connection established. Creating tables if necessary...")
-    Base.metadata.create_all(engine, checkfirst=True)
+    init_schema(engine, force=ns.init_schema)
+    print("Done. Starting parser workers...")
+    n_workers = ns.workers
+    if n_workers is None:
+        n_workers = max(1, (os.cpu_count() or 1) - 1)
+    if (multiprocessing is not None) and (n_workers > 1):
+        pool_context = multiprocessing.Pool(n_workers)
+    else:
+        print(" -> Parsing in main process.")
+        pool_context = contextlib.nullcontext()
     print("Done. Creating databse session...")
-    with Session(engine) as session:
+    with pool_context as pool, Session(engine, autoflush=False) as session:
         print("Done. Preparing database...")
         prepare_db(session)
+        comments = None
+        if ns.comments_file is not None:
+            # when using a pool, this already starts parsing the comments
+            # while the posts are being imported
+            comments = read_jsonl(ns.comments_file, desc="Importing comments", pool=pool, keys=COMMENT_IMPORT_KEYS)
         print("Done. Importing posts...")
         if ns.posts_file is not None:
-            import_posts_from_file(session, path=ns.posts_file, batch_size=ns.batch_size)
+            import_posts_from_file(
+                session,
+                path=ns.posts_file,
+                batch_size=ns.batch_size,
+                pool=pool,
+                commit_every=ns.commit_every,
+            )
         else:
             print(" -> No posts file specified, skipping...")
         print("Done. Importing comments..")
-        if ns.comments_file is not None:
-            import_comments_from_file(session, path=ns.comments_file, batch_size=ns.batch_size)
+        if comments is not None:
+            import_comments_from_iterable(
+                session,
+                comments,
+                batch_size=ns.batch_size,
+                commit_every=ns.commit_every,
+            )
         else:
             print(" -> No comments file specified, skipping...")
     print("Import finished in  {}".format(format_timedelta(time.time() - start)))
 
 
+def run_init_db(ns):
+    """
+    Run the init-db command.
+
+    @param ns: namespace containing arguments
+    @type ns: L{argparse.Namespace}
+    """
+    from .db.connection import init_schema
+
+    print("Connecting to database...")
+    engine = _connection_config_from_ns(ns).connect()
+    print("Database connection established. Creating tables...")
+    init_schema(engine, force=True)
+    print("Done.")
+
+
 def run_fetch(ns):
     """
     Run the fetch-extra command.
@@ -111,18 +157,36 @@ def run_fetch(ns):
     @param ns: namespace containing arguments
     @type ns: L{argparse.Namespace}
     """
+    from sqlalchemy.orm import Session
+
+    from .db.connection import init_schema
+    from .fetcher import fetch_all
+    from .net import HostRateLimiter
+
     start = time.time()
     print("Connecting to database...")
     engine = _connection_config_from_ns(ns).connect()
     print("Database connection established. Creating tables if necessary...")
-    Base.metadata.create_all(engine, checkfirst=True)
+    init_schema(engine, force=ns.init_schema)
+    if ns.jobs > 1:
+        executor_context = concurrent.futures.ThreadPoolExecutor(max_workers=ns.jobs)
+    else:
+        executor_context = contextlib.nullcontext()
     print("Done. Creating databse session...")
-    with Session(engine) as session:
+    with executor_context as executor, Session(engine) as session:
         print("Done. Starting fetch...")
+        # the rate limit applies to the requests of all fetch rounds
+        rate_limiter = HostRateLimiter(ns.sleep)
         rnd = 1
         while True:
             print("Fetch round #{}".format(rnd))
-            did_fetch_something = fetch_all(session, sleep=ns.sleep)
+            did_fetch_something = fetch_all(
+                session,
+                sleep=ns.sleep,
+                fetch_size=ns.fetch_size,
+                executor=executor,
+                rate_limiter=rate_limiter,
+            )
             if ns.single:
                 print("--single specified, stopping after first fetch round")
                 break
@@ -142,6 +206,8 @@ def run_build(ns):
     @param ns: namespace containing arguments
     @type ns: L{argparse.Namespace}
     """
+    from .zimbuild.builder import ZimBuilder
+
     connection_config = _connection_config_from_ns(ns)
     builder = ZimBuilder(connection_config, mediadir=ns.mediadir)
     build_options = BuildOptions.from_ns(ns)
@@ -155,6 +221,11 @@ def run_media_download(ns):
     @param ns: namespace containing arguments
     @type ns: L{argparse.Namespace}
     """
+    from sqlalchemy.orm import Session
+
+    from .downloader import download_all as download_all_media
+    from .imgutils import check_ffmpeg
+
     print("Checking preconditions...")
     if ns.post_processing and not check_ffmpeg():
         print("WARNING: ffmpeg is not available, videos can not be post processed!")
@@ -178,6 +249,10 @@ def run_media_download(ns):
             ignore_postprocessing_errors=ns.ignore_postprocessing_errors,
             dry=ns.dry,
             sleep=ns.sleep,
+            n_workers=ns.download_workers,
+            prefetch_window=ns.prefetch_window,
+            cpu_workers=ns.cpu_workers,
+            max_file_size=(ns.max_file_size * 1024 * 1024 if ns.max_file_size is not None else None),
         )
     print("Download complete. Downloaded {} files.".format(n_downloaded))
 
@@ -189,6 +264,10 @@ def run_media_check(ns):
     @param ns: namespace containing arguments
     @type ns: L{argparse.Namespace}
     """
+    from sqlalchemy.orm import Session
+
+    from .downloader import check_all as check_all_media
+
     print("Creating media directory if neccessary...")
     if not os.path.exists(ns.mediadir):
         os.mkdir(ns.mediadir)
@@ -212,6 +291,10 @@ def run_media_delete(ns):
     @param ns: namespace containing arguments
     @type ns: L{argparse.Namespace}
     """
+    from sqlalchemy.orm import Session
+
+    from .downloader import delete_all as delete_all_media
+
     print("Creating media directory if neccessary...")
     if not os.path.exists(ns.mediadir):
         os.mkdir(ns.mediadir)
@@ -230,6 +313,59 @@ def run_media_delete(ns):
     print("Done. Deleted {} files.".format(n_deleted))
 
 
+def run_profiled(f, ns):
+    """
+    Run a command, profiling it.
+
+    @param f: the function implementing the command
+    @type f: callable
+    @param ns: namespace containing arguments
+    @type ns: L{argparse.Namespace}
+    """
+    if ns.profile_tool == "cprofile":
+        import cProfile
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(f, ns)
+        finally:
+            profiler.dump_stats(ns.profile)
+    elif ns.profile_tool == "yappi":
+        try:
+            import yappi
+        except ImportError:
+            raise RuntimeError("yappi is required to use --profile-tool=yappi!")
+        yappi.set_clock_type("wall")
+        yappi.start()
+        try:
+            f(ns)
+        finally:
+            yappi.stop()
+            yappi.get_func_stats().save(ns.profile, type="pstat")
+    elif ns.profile_tool == "py-spy":
+        import subprocess
+        import signal
+
+        profiler = subprocess.Popen(
+            [
+                "py-spy",
+                "record",
+                "--output", ns.profile,
+                "--pid", str(os.getpid()),
+                "--subprocesses",
+            ],
+        )
+        try:
+            f(ns)
+        finally:
+            # py-spy writes the profile when interrupted
+            profiler.send_signal(signal.SIGINT)
+            profiler.wait()
+    else:
+        raise ValueError("Unknown profile tool: {}".format(ns.profile_tool))
+    print("Profile written to '{}'.".format(ns.profile))
+
+
 def main():
     """
     The main function.
@@ -242,6 +378,21 @@ def main():
         default=0,
         help="be more verbose",
     )
+    parser.add_argument(
+        "--profile",
+        action="store",
+        dest="profile",
+        default=None,
+        help="profile the command, writing the profile to this path",
+    )
+    parser.add_argument(
+        "--profile-tool",
+        action="store",
+        dest="profile_tool",
+        choices=("cprofile", "yappi", "py-spy"),
+        default="cprofile",
+        help="profiler to use with --profile",
+    )
     subparsers = parser.add_subparsers(
         dest="command",
         required=True,
@@ -279,6 +430,17 @@ def main():
     )
 
 
+    # parser for init-db
+    initdb_parser = subparsers.add_parser(
+        "init-db",
+        help="create the tables of a database",
+    )
+    initdb_parser.add_argument(
+        "database",
+        action="store",
+        help="database to initialize, as sqlalchemy connection URL",
+    )
+
     # parser for the import
     import_parser = subparsers.add_parser(
         "import",
@@ -301,14 +463,45 @@ def main():
         dest="comments_file",
         help="Path to file containing comment data to import from",
     )
+    import_parser.add_argument(
+        "--init-schema",
+        action="store_true",
+        dest="init_schema",
+        help="always check each table of the schema instead of only checking if all tables exist",
+    )
     import_parser.add_argument(
         "--batch-size",
         action="store",
         type=int,
         dest="batch_size",
-        default=1000,
+        default=10000,
         help="how many posts and comments to import at once",
     )
+    import_parser.add_argument(
+        "--insert-page-size",
+        action="store",
+        type=int,
+        dest="insert_page_size",
+        default=None,
+        help="max number of rows per INSERT statement, defaults to the value recommended for the database",
+    )
+    import_parser.add_argument(
+        "--commit-every",
+        action="store",
+        type=int,
+        dest="commit_every",
+        default=0,
+        help="commit after this many batches, 0 (default) to commit once per file",
+    )
+    import_parser.add_argument(
+        "-w",
+        "--workers",
+        action="store",
+        type=int,
+        dest="workers",
+        default=None,
+        help="number of processes used to parse the input files, defaults to CPU count - 1",
+    )
 
     fetch_parser = subparsers.add_parser(
         "fetch-extra",
@@ -319,6 +512,12 @@ def main():
         action="store",
         help="database to load objects from, as sqlalchemy connection URL",
     )
+    fetch_parser.add_argument(
+        "--init-schema",
+        action="store_true",
+        dest="init_schema",
+        help="always check each table of the schema instead of only checking if all tables exist",
+    )
     fetch_parser.add_argument(
         "--sleep",
         action="store",
@@ -331,6 +530,23 @@ def main():
         action="store_true",
         help="Perform at most a single fetch round.",
     )
+    fetch_parser.add_argument(
+        "--fetch-size",
+        action="store",
+        type=int,
+        dest="fetch_size",
+        default=1000,
+        help="fetch this many rows at once when searching for references",
+    )
+    fetch_parser.add_argument(
+        "-J",
+        "--jobs",
+        action="store",
+        type=int,
+        dest="jobs",
+        default=1,
+        help="perform up to this many independent requests in parallel, --sleep still applies to all requests combined",
+    )
 
     mediadownload_parser = subparsers.add_parser(
         "download-media",
@@ -353,7 +569,7 @@ def main():
         action="store",
         type=float,
         default=1,
-        help="how many seconds to wait between requests",
+        help="how many seconds to wait between requests to the same host",
     )
     mediadownload_parser.add_argument(
         "--no-post-processing",
@@ -399,6 +615,38 @@ def main():
         dest="dry",
         help="don't actually download anything",
     )
+    mediadownload_parser.add_argument(
+        "--download-workers",
+        action="store",
+        type=int,
+        dest="download_workers",
+        default=8,
+        help="number of threads to download files in (downloads are I/O bound, so this may exceed the CPU count)",
+    )
+    mediadownload_parser.add_argument(
+        "--prefetch-window",
+        action="store",
+        type=int,
+        dest="prefetch_window",
+        default=8,
+        help="number of downloads queued per download worker",
+    )
+    mediadownload_parser.add_argument(
+        "--cpu-workers",
+        action="store",
+        type=int,
+        dest="cpu_workers",
+        default=(os.cpu_count() or 1),
+        help="number of processes to post-process downloaded files in",
+    )
+    mediadownload_parser.add_argument(
+        "--max-file-size",
+        action="store",
+        type=int,
+        dest="max_file_size",
+        default=None,
+        help="do not download files larger than this many MiB",
+    )
 
     mediacheck_parser = subparsers.add_parser(
         "check-media",
@@ -478,22 +726,29 @@ def main():
 
     ns = parser.parse_args()
 
-    if ns.command == "retrieve":
-        run_retrieve(ns)
-    elif ns.command == "import":
-        run_import(ns)
-    elif ns.command == "fetch-extra":
-        run_fetch(ns)
-    elif ns.command == "download-media":
-        run_media_download(ns)
-    elif ns.command == "check-media":
-        run_media_check(ns)
-    elif ns.command == "delete-media":
-        run_media_delete(ns)
-    elif ns.command == "build":
-        run_build(ns)
-    else:
+    if (multiprocessing is not None) and (ns.command in MULTIPROCESSING_COMMANDS):
+        try:
+            multiprocessing.set_start_method("forkserver")
+        except Exception:
+            # start method may not be available
+            pass
+
+    commands = {
+        "retrieve": run_retrieve,
+        "init-db": run_init_db,
+        "import": run_import,
+        "fetch-extra": run_fetch,
+        "download-media": run_media_download,
+        "check-media": run_media_check,
+        "delete-media": run_media_delete,
+        "build": run_build,
+    }
+    if ns.command not in commands:
         raise RuntimeError("Unknown subcommand: {}".format(ns.command))
+    if ns.profile is not None:
+        run_profiled(commands[ns.command], ns)
+    else:
+        commands[ns.command](ns)
 
 
 if __name__ == "__main__":
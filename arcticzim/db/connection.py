@@ -1,8 +1,16 @@
 """
 This module contains the connection handling.
+
+@var SQLITE_BUSY_TIMEOUT: how many seconds a sqlite connection waits for a lock
+@type SQLITE_BUSY_TIMEOUT: L{int}
 """
-from sqlalchemy import create_engine, event
-from sqlalchemy.engine import Engine
+import os
+
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.engine import Engine, make_url
+
+
+SQLITE_BUSY_TIMEOUT = 30
 
 
 def enable_foreign_keys(dbapi_conn):
@@ -17,6 +25,23 @@ def enable_foreign_keys(dbapi_conn):
     cursor.close()
 
 
+def set_sqlite_pragmas(dbapi_conn):
+    """
+    Configure a sqlite connection for faster writes.
+
+    This enables write-ahead logging, which also allows reading while
+    writing, and reduces the number of syncs.
+
+    @param dbapi_conn: database connection
+    @type dbapi_conn: L{sqlalchemy.engine.interfaces.DBAPIConnection}
+    """
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
 @event.listens_for(Engine, "connect")
 def enable_foreign_keys_on_connect(dbapi_connection, connection_record):
     """
@@ -30,6 +55,7 @@ def enable_foreign_keys_on_connect(dbapi_connection, connection_record):
     # Check if the connection URL is SQLite
     if "sqlite" in str(connection_record.driver_connection):
         enable_foreign_keys(dbapi_connection)
+        set_sqlite_pragmas(dbapi_connection)
 
 
 class ConnectionConfig(object):
@@ -40,8 +66,10 @@ class ConnectionConfig(object):
     @type url: L{str}
     @ivar verbose: if nonzero, be verbose
     @type verbose: L{bool}
+    @ivar insert_page_size: max number of rows per batched INSERT statement (None -> dialect default)
+    @type insert_page_size: L{int} or L{None}
     """
-    def __init__(self, url, verbose=False):
+    def __init__(self, url, verbose=False, insert_page_size=None):
         """
         The default constructor.
 
@@ -49,11 +77,40 @@ class ConnectionConfig(object):
         @type url: L{str}
         @param verbose: if nonzero, be verbose
         @type verbose: L{bool}
+        @param insert_page_size: max number of rows per batched INSERT statement (None -> dialect default)
+        @type insert_page_size: L{int} or L{None}
         """
         assert isinstance(url, str)
+        assert isinstance(insert_page_size, int) or (insert_page_size is None)
 
         self.url = url
         self.verbose = verbose
+        self.insert_page_size = insert_page_size
+
+    def get_engine_kwargs(self):
+        """
+        Return the additional keyword arguments for creating the engine.
+
+        @return: keyword arguments to pass to L{sqlalchemy.create_engine}
+        @rtype: L{dict}
+        """
+        kwargs = {}
+        url = make_url(self.url)
+        if self.insert_page_size is not None:
+            kwargs["insertmanyvalues_page_size"] = self.insert_page_size
+        if url.get_backend_name() == "postgresql" and url.get_driver_name() == "psycopg2":
+            # batch executemany() calls not handled by insertmanyvalues
+            kwargs["executemany_mode"] = "values_plus_batch"
+        if url.get_backend_name() == "sqlite":
+            # wait for locks held by other connections (e.g. build workers) instead of failing
+            kwargs["connect_args"] = {"timeout": SQLITE_BUSY_TIMEOUT}
+        else:
+            # keep enough connections to a database server alive and prefer recently used ones
+            kwargs["pool_size"] = max(8, os.cpu_count() or 1)
+            kwargs["pool_pre_ping"] = True
+            kwargs["pool_recycle"] = 1800
+            kwargs["pool_use_lifo"] = True
+        return kwargs
 
     def connect(self):
         """
@@ -67,7 +124,32 @@ class ConnectionConfig(object):
         engine = create_engine(
             self.url,
             echo=self.verbose,
+            **self.get_engine_kwargs(),
         )
         if self.verbose:
             print("Connected.")
         return engine
+
+
+def init_schema(engine, force=False):
+    """
+    Create the tables of the database if necessary.
+
+    Unless forced, this first checks if all tables already exist using
+    a single query and only creates the schema if any table is missing.
+
+    @param engine: engine of the database to initialize
+    @type engine: L{sqlalchemy.engine.Engine}
+    @param force: if nonzero, always run the (per table) schema creation
+    @type force: L{bool}
+    @return: whether the schema creation was run
+    @rtype: L{bool}
+    """
+    from .models import Base
+
+    if not force:
+        existing_tables = set(inspect(engine).get_table_names())
+        if all(table.name in existing_tables for table in Base.metadata.sorted_tables):
+            return False
+    Base.metadata.create_all(engine, checkfirst=True)
+    return True
@@ -3,6 +3,8 @@ Database model definitions.
 
 @var ARCTICZIM_USERNAME: a username used as author for some helper objects
 @type ARCTICZIM_USERNAME: L{str}
+@var LARGE_COLUMN_SORT_ORDER: sort order placing large text columns after all other columns of a table
+@type LARGE_COLUMN_SORT_ORDER: L{int}
 """
 import datetime
 import json
@@ -10,14 +12,23 @@ from urllib.parse import urlparse, parse_qs
 
 from typing import List, Optional
 
-from sqlalchemy import ForeignKey, UniqueConstraint
-from sqlalchemy import String, Unicode
+from sqlalchemy import ForeignKey, UniqueConstraint, Index
+from sqlalchemy import String, Unicode, UnicodeText
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 from ..util import parse_reddit_url
 
 
 ARCTICZIM_USERNAME = "_ArcticZim"
+LARGE_COLUMN_SORT_ORDER = 100
+# post hint -> icon name, see Post.icon_name
+_POST_ICONS = {
+    "rich:video": "video",
+    "hosted:video": "video",
+    "image": "img",
+    "link": "link",
+    "self": "text",
+}
 
 
 class Base(DeclarativeBase):
@@ -125,7 +136,7 @@ class Post(Base):
     link_flair_text_color: Mapped[Optional[str]] = mapped_column(Unicode(16))
     link_flair_type: Mapped[Optional[str]] = mapped_column(Unicode(8))
     locked: Mapped[Optional[bool]]
-    media_metadata: Mapped[Optional[str]] = mapped_column(Unicode(4096))
+    media_metadata: Mapped[Optional[str]] = mapped_column(UnicodeText, sort_order=LARGE_COLUMN_SORT_ORDER)
     media_only: Mapped[Optional[bool]]
     name: Mapped[str] = mapped_column(String(16), index=True, unique=True)
     no_follow: Mapped[Optional[bool]]
@@ -136,9 +147,9 @@ class Post(Base):
     parent_whitelist_status: Mapped[Optional[str]] = mapped_column(Unicode(8))
     permalink: Mapped[str] = mapped_column(Unicode(128))
     pinned: Mapped[Optional[bool]]
-    poll_data: Mapped[Optional[str]] = mapped_column(Unicode(4096))
+    poll_data: Mapped[Optional[str]] = mapped_column(UnicodeText, sort_order=LARGE_COLUMN_SORT_ORDER)
     post_hint: Mapped[Optional[str]] = mapped_column(Unicode(16))
-    previous_selftext: Mapped[Optional[str]] = mapped_column(Unicode(65536), deferred=True)
+    previous_selftext: Mapped[Optional[str]] = mapped_column(UnicodeText, deferred=True, sort_order=LARGE_COLUMN_SORT_ORDER)
     quarantine: Mapped[Optional[bool]]
     removal_reason: Mapped[Optional[str]] = mapped_column(Unicode(8))
     removed_by_category: Mapped[Optional[str]] = mapped_column(Unicode(16))
@@ -146,7 +157,7 @@ class Post(Base):
     retrieved_utc: Mapped[Optional[int]]
     rte_mode: Mapped[Optional[str]] = mapped_column(Unicode(8))
     score: Mapped[int]
-    selftext: Mapped[str] = mapped_column(Unicode(65536), deferred=True)
+    selftext: Mapped[str] = mapped_column(UnicodeText, deferred=True, sort_order=LARGE_COLUMN_SORT_ORDER)
     # selftext_html: Mapped[Optional[str]] = Unicode(4096)
     spoiler: Mapped[bool]
     stickied: Mapped[Optional[bool]]
@@ -229,14 +240,7 @@ class Post(Base):
         """
         if self.is_poll:
             return "poll"
-        icons = {
-            "rich:video": "video",
-            "hosted:video": "video",
-            "image": "img",
-            "link": "link",
-            "self": "text",
-        }
-        name = icons.get(self.post_hint, None)
+        name = _POST_ICONS.get(self.post_hint, None)
         if name is None:
             if self.is_self:
                 return "text"
@@ -342,8 +346,8 @@ class Comment(Base):
     author_is_blocked: Mapped[Optional[bool]]
     author_patreon_flair: Mapped[Optional[bool]]
     author_premium: Mapped[Optional[bool]]
-    body: Mapped[str] = mapped_column(Unicode(16384), deferred=True)
-    body_html: Mapped[Optional[str]] = mapped_column(Unicode(4096), deferred=True)
+    body: Mapped[str] = mapped_column(UnicodeText, deferred=True, sort_order=LARGE_COLUMN_SORT_ORDER)
+    body_html: Mapped[Optional[str]] = mapped_column(UnicodeText, deferred=True, sort_order=LARGE_COLUMN_SORT_ORDER)
     body_sha1: Mapped[Optional[str]] = mapped_column(Unicode(64), deferred=True)
     can_gild: Mapped[Optional[bool]]
     can_mod_post: Mapped[Optional[bool]]
@@ -432,11 +436,12 @@ class MediaFile(Base):
     """
     __tablename__ = "mediafile"
     __table_args__ = (
-        UniqueConstraint("url"),
+        # covers the lookup of the primary mediafile of a checksum
+        Index("ix_mediafile_md5_downloaded_primary_uid", "md5", "downloaded", "primary_uid"),
     )
     uid: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     url: Mapped[str] = mapped_column(String(20248), unique=True, index=True)
-    md5: Mapped[str] = mapped_column(String(32), index=True, nullable=True)
+    md5: Mapped[str] = mapped_column(String(32), nullable=True)
     mimetype: Mapped[str] = mapped_column(String(256), index=True, nullable=True)
     # extension: Mapped[str] = mapped_column(String(64))
     downloaded: Mapped[bool]
@@ -463,7 +468,7 @@ class WikiPage(Base):
     uid: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     subreddit_name: Mapped[str] = mapped_column(ForeignKey("subreddit.name"), index=True)
     path: Mapped[str] = mapped_column(Unicode(512), deferred=True)
-    content: Mapped[str] = mapped_column(Unicode(20 * 1024), deferred=True)
+    content: Mapped[str] = mapped_column(UnicodeText, deferred=True)
     revision_date: Mapped[int]
     revision_author: Mapped[str] = mapped_column(String(32))
     revision_reason: Mapped[Optional[str]] = mapped_column(Unicode(256), deferred=True)
@@ -1,17 +1,44 @@
 """
 This module contains the code for downloading media files.
+
+Queries scanning all posts only select the columns they need instead
+of loading ORM objects, so that no relationship can accidentally be
+lazy loaded for each post.
+
+@var WRITE_BUFFER_SIZE: size of the write buffer for downloaded files, in bytes
+@type WRITE_BUFFER_SIZE: L{int}
+@var DOWNLOAD_CHUNK_SIZE: size of the chunks downloaded files are read and hashed in, in bytes
+@type DOWNLOAD_CHUNK_SIZE: L{int}
+@var DEFAULT_PREFETCH_WINDOW: default number of downloads queued per download worker
+@type DEFAULT_PREFETCH_WINDOW: L{int}
+@var MEDIAFILE_WRITE_BATCH_SIZE: number of new mediafiles to insert at once
+@type MEDIAFILE_WRITE_BATCH_SIZE: L{int}
+@var UNIFY_URL_CACHE_SIZE: number of unified and hashed URLs to cache
+@type UNIFY_URL_CACHE_SIZE: L{int}
+@var YTDLP_URL_CACHE_SIZE: number of URLs to cache the yt-dlp classification of
+@type YTDLP_URL_CACHE_SIZE: L{int}
+@var IMAGE_EXTENSIONS: lowercase file extensions of image mimetypes
+@type IMAGE_EXTENSIONS: L{frozenset} of L{str}
+@var VIDEO_EXTENSIONS: lowercase file extensions of video mimetypes
+@type VIDEO_EXTENSIONS: L{frozenset} of L{str}
+@var POST_MEDIA_COLUMNS: the post columns used by L{get_urls_from_post}
+@type POST_MEDIA_COLUMNS: L{tuple} of L{sqlalchemy.orm.InstrumentedAttribute}
 """
 import os
+import contextlib
+import collections
+import functools
+import concurrent.futures
 import hashlib
-import time
-import json
-import subprocess
 import shutil
+import mimetypes
 from mimetypes import guess_type
 from urllib.parse import urlparse, parse_qsl, unquote_plus, urlunparse, urlencode
 
-from sqlalchemy import select, delete, func, or_
-from sqlalchemy.orm import undefer, selectinload
+from sqlalchemy import select, insert, delete, func, or_
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
 import requests
 import tqdm
 from yt_dlp import YoutubeDL
@@ -19,7 +46,30 @@ from redvid import Downloader as RedvidDL
 
 from .db.models import MediaFile, Post, Comment
 from .imgutils import minimize_image, mimetype_is_image, mimetype_is_video, reencode_video
-from .util import get_urls_from_string
+from .util import URL, iter_urls_from_string, chunked
+from .importer import IN_QUERY_BATCH_SIZE
+from .net import get_http_session, get_url_host, HostRateLimiter, HTTP_RETRIES, HTTP_TIMEOUT
+from .jsonl import loads_json
+
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DEFAULT_PREFETCH_WINDOW = 8
+MEDIAFILE_WRITE_BATCH_SIZE = 1000
+UNIFY_URL_CACHE_SIZE = 64 * 1024
+YTDLP_URL_CACHE_SIZE = 64 * 1024
+# load the system mimetypes before building the extension sets
+mimetypes.init()
+IMAGE_EXTENSIONS = frozenset(ext.lower() for ext, mt in mimetypes.types_map.items() if mt.startswith("image/"))
+VIDEO_EXTENSIONS = frozenset(ext.lower() for ext, mt in mimetypes.types_map.items() if mt.startswith("video/"))
+POST_MEDIA_COLUMNS = (
+    Post.uid,
+    Post.post_hint,
+    Post.url,
+    Post.media_metadata,
+    Post.selftext,
+    Post.is_gallery,
+)
 
 
 class DownloadFailed(Exception):
@@ -29,12 +79,14 @@ class DownloadFailed(Exception):
     pass
 
 
+@functools.lru_cache(maxsize=UNIFY_URL_CACHE_SIZE)
 def unify_url(url):
     """
     Transform an URL into a "unified" URL used to identify similiar URLs.
 
     The resulting URL may not be valid and is only supposed to be used
-    for identifying if two URLs are the same.
+    for identifying if two URLs are the same. As the same URLs tend to
+    be referenced repeatedly, the results are cached.
 
     @param url: URL to unify
     @type url: L{str}
@@ -51,9 +103,10 @@ def unify_url(url):
         list(sorted(frozenset(parse_qsl(parts.query)))),
     )
     _path = parts.path
-    while True:
+    while ("%" in _path) or ("+" in _path):
         # using a loop here as a URL may be urlencoded multiple times
         # and we need the output here to be stable
+        # unquote_plus() only changes paths containing these characters
         unquoted = unquote_plus(_path)
         if unquoted == _path:
             break
@@ -67,19 +120,112 @@ def unify_url(url):
     return urlunparse(parts)
 
 
+@functools.lru_cache(maxsize=UNIFY_URL_CACHE_SIZE)
 def hash_url(url):
     """
     Hash a url, returning the hexdigest.
 
+    Like with L{unify_url}, the results are cached.
+
     @param url: URL to hash
     @type url: L{str}
     @return: the hashed url
     @rtype: L{str}
     """
-    hasher = hashlib.md5(unify_url(url).encode("utf-8"))
+    return hash_unified_url(unify_url(url))
+
+
+def hash_unified_url(unified_url):
+    """
+    Hash an already unified url, returning the hexdigest.
+
+    This is equivalent to L{hash_url}, but skips unifying the URL again.
+
+    @param unified_url: unified URL to hash, as returned by L{unify_url}
+    @type unified_url: L{str}
+    @return: the hashed url
+    @rtype: L{str}
+    """
+    hasher = new_md5(unified_url.encode("utf-8"))
     return hasher.hexdigest()
 
 
+def new_md5(data=b""):
+    """
+    Create a new md5 hasher.
+
+    md5 is only used to identify files and URLs, so the hasher is marked
+    as not being used for security where supported (python 3.9+). This
+    keeps it usable on FIPS-restricted systems.
+
+    @param data: initial data to hash
+    @type data: L{bytes}
+    @return: the hasher
+    @rtype: hashlib hash object
+    """
+    try:
+        return hashlib.md5(data, usedforsecurity=False)
+    except TypeError:
+        # python < 3.9
+        return hashlib.md5(data)
+
+
+def get_url_extension(url):
+    """
+    Return the lowercase file extension of the path of an URL.
+
+    Checking the result against L{IMAGE_EXTENSIONS} and
+    L{VIDEO_EXTENSIONS} is a cheaper alternative to guessing the
+    mimetype of the URL.
+
+    @param url: url to get the extension of
+    @type url: L{str}
+    @return: the extension including the leading dot, or an empty string
+    @rtype: L{str}
+    """
+    return os.path.splitext(urlparse(url).path)[1].lower()
+
+
+def get_attempted_urls(session):
+    """
+    Return the set of all URLs whose download has already been attempted.
+
+    This allows checking many URLs without querying the database for
+    each of them, see L{has_downloaded}.
+
+    @param session: sqlalchemy session
+    @type session: L{sqlalchemy.orm.Session}
+    @return: the unified URLs of all mediafiles
+    @rtype: L{set} of L{str}
+    """
+    stmt = select(MediaFile.url).execution_options(yield_per=10000)
+    return set(session.execute(stmt).scalars())
+
+
+def interleave_by_host(urls):
+    """
+    Reorder URLs so that consecutive URLs are from different hosts if possible.
+
+    The order of the URLs of each host is kept.
+
+    @param urls: URLs to reorder
+    @type urls: iterable of L{str}
+    @return: the reordered URLs
+    @rtype: L{list} of L{str}
+    """
+    by_host = collections.OrderedDict()
+    for url in urls:
+        by_host.setdefault(get_url_host(url), collections.deque()).append(url)
+    interleaved = []
+    while by_host:
+        for host in list(by_host.keys()):
+            host_urls = by_host[host]
+            interleaved.append(host_urls.popleft())
+            if not host_urls:
+                del by_host[host]
+    return interleaved
+
+
 def has_downloaded(session, url, any_status=True):
     """
     Check if the URL has already been downloaded.
@@ -103,127 +249,694 @@ def has_downloaded(session, url, any_status=True):
     return (mf is not None)
 
 
-def download(
-    session,
-    url,
-    mediadir,
-    enable_post_processing=True,
-    download_videos=True,
-    max_image_dimension=512,
-    ignore_postprocessing_errors=False,
-):
+class DownloadOptions(object):
     """
-    Download the media at the specified URL.
+    Options for downloading media files.
 
-    @param session: sqlalchemy session
-    @type session: L{sqlalchemy.orm.Session}
-    @param url: url to download
-    @type url: L{str}
-    @param mediadir: directory where files should be downloaded too
+    Instances of this class are sent to the download and
+    post-processing workers.
+
+    @ivar mediadir: directory where files should be downloaded too
     @type mediadir: L{str}
-    @param enable_post_processing: whether post-processing should be applied
+    @ivar enable_post_processing: whether post-processing should be applied
     @type enable_post_processing: L{bool}
-    @param download_videos: whether videos should be downloaded
+    @ivar download_videos: whether videos should be downloaded
     @type download_videos: L{bool}
-    @param max_image_dimension: how many pixels the wider side of an image may have at most
+    @ivar max_image_dimension: how many pixels the wider side of an image may have at most
     @type max_image_dimension: L{int}
-    @param ignore_postprocessing_errors: if nonzero, ignore postprocessing errors
+    @ivar ignore_postprocessing_errors: if nonzero, ignore postprocessing errors
     @type ignore_postprocessing_errors: L{bool}
-    @return: whether the file was downloaded or not
-    @rtype: l{bool}
+    @ivar sleep: min time between two downloads from the same host in seconds
+    @type sleep: L{int} or L{float}
+    @ivar max_file_size: if specified, do not download files larger than this many bytes
+    @type max_file_size: L{int} or L{None}
+    """
+    def __init__(
+        self,
+        mediadir,
+        enable_post_processing=True,
+        download_videos=True,
+        max_image_dimension=512,
+        ignore_postprocessing_errors=False,
+        sleep=0,
+        max_file_size=None,
+    ):
+        """
+        The default constructor.
+
+        @param mediadir: directory where files should be downloaded too
+        @type mediadir: L{str}
+        @param enable_post_processing: whether post-processing should be applied
+        @type enable_post_processing: L{bool}
+        @param download_videos: whether videos should be downloaded
+        @type download_videos: L{bool}
+        @param max_image_dimension: how many pixels the wider side of an image may have at most
+        @type max_image_dimension: L{int}
+        @param ignore_postprocessing_errors: if nonzero, ignore postprocessing errors
+        @type ignore_postprocessing_errors: L{bool}
+        @param sleep: min time between two downloads from the same host in seconds
+        @type sleep: L{int} or L{float}
+        @param max_file_size: if specified, do not download files larger than this many bytes
+        @type max_file_size: L{int} or L{None}
+        """
+        self.mediadir = mediadir
+        self.enable_post_processing = enable_post_processing
+        self.download_videos = download_videos
+        self.max_image_dimension = max_image_dimension
+        self.ignore_postprocessing_errors = ignore_postprocessing_errors
+        self.sleep = sleep
+        self.max_file_size = max_file_size
+
+
+class DownloadResult(object):
+    """
+    The result of a download, to be stored in the database.
+
+    @ivar url: the unified URL that was downloaded
+    @type url: L{str}
+    @ivar downloaded: whether the download was successfull
+    @type downloaded: L{bool}
+    @ivar md5: md5 hexdigest of the downloaded file, before post-processing
+    @type md5: L{str} or L{None}
+    @ivar mimetype: mimetype of the file
+    @type mimetype: L{str} or L{None}
+    @ivar size: size of the file
+    @type size: L{int} or L{None}
+    """
+    def __init__(self, url, downloaded, md5=None, mimetype=None, size=None):
+        """
+        The default constructor.
+
+        @param url: the unified URL that was downloaded
+        @type url: L{str}
+        @param downloaded: whether the download was successfull
+        @type downloaded: L{bool}
+        @param md5: md5 hexdigest of the downloaded file, before post-processing
+        @type md5: L{str} or L{None}
+        @param mimetype: mimetype of the file
+        @type mimetype: L{str} or L{None}
+        @param size: size of the file
+        @type size: L{int} or L{None}
+        """
+        self.url = url
+        self.downloaded = downloaded
+        self.md5 = md5
+        self.mimetype = mimetype
+        self.size = size
+
+
+def _preallocate(f, size):
     """
-    url_hash = hash_url(url)
+    Allocate the disk space for a file before writing it.
+
+    This reduces the fragmentation of the file. On platforms not
+    supporting this, nothing happens.
+
+    @param f: file to allocate space for
+    @type f: file-like object
+    @param size: expected size of the file in bytes
+    @type size: L{int}
+    """
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except (AttributeError, OSError):
+        # not supported by OS or filesystem
+        pass
+
+
+def _hash_file(path):
+    """
+    Calculate the md5 hexdigest and the size of a file.
+
+    Where available, L{hashlib.file_digest} is used, which reads and
+    hashes the file without executing python code for each chunk.
+
+    @param path: path of the file to hash
+    @type path: L{str}
+    @return: a tuple of (md5 hexdigest, size in bytes)
+    @rtype: L{tuple} of (L{str}, L{int})
+    """
+    with open(path, "rb") as fin:
+        if hasattr(hashlib, "file_digest"):
+            # python 3.11+
+            hasher = hashlib.file_digest(fin, new_md5)
+        else:
+            hasher = new_md5()
+            chunk = True
+            while chunk:
+                chunk = fin.read(DOWNLOAD_CHUNK_SIZE)
+                hasher.update(chunk)
+        size = fin.tell()
+    return (hasher.hexdigest(), size)
+
+
+def _request_media(url, headers):
+    """
+    Start a streamed GET request for a media file.
+
+    @param url: url to request
+    @type url: L{str}
+    @param headers: headers to send
+    @type headers: L{dict}
+    @return: the response, with the body not yet read
+    @rtype: L{requests.Response}
+    @raises DownloadFailed: if the request failed
+    """
+    try:
+        r = get_http_session().get(url, headers=headers, stream=True, timeout=HTTP_TIMEOUT)
+        r.raise_for_status()
+    except Exception as e:
+        raise DownloadFailed() from e
+    return r
+
+
+def fetch_media(url, options):
+    """
+    Download the media at the specified URL.
+
+    This function does not access the database, so it can be used in
+    worker threads. Use L{post_process_download} to post-process the file
+    and L{record_download} to store the result.
+
+    @param url: url to download
+    @type url: L{str}
+    @param options: options for the download
+    @type options: L{DownloadOptions}
+    @return: the result of the download or None if the URL should not be downloaded
+    @rtype: L{DownloadResult} or L{None}
+    """
+    mediadir = options.mediadir
+    unified_url = unify_url(url)
+    url_hash = hash_unified_url(unified_url)
     outpath = os.path.join(mediadir, url_hash)
-    guessed_mimetype = guess_type(urlparse(url).path)[0]
-    is_probably_image = (guessed_mimetype is not None) and (guessed_mimetype.startswith("image/"))
+    is_probably_image = (get_url_extension(url) in IMAGE_EXTENSIONS)
     try:
         if (is_ytdlp(url) or is_redvid(url)) and not is_probably_image:
-            if not download_videos:
-                return False
+            if not options.download_videos:
+                return None
             if is_redvid(url):
                 mimetype = do_redvid_download(url=url, mediadir=mediadir, outpath=outpath)
             else:
                 mimetype = do_ytldp_download(url=url, mediadir=mediadir, outpath=outpath)
-            hasher = hashlib.md5()
-            size = 0
-            with open(outpath, "rb") as fin:
-                chunk = True
-                while chunk:
-                    chunk = fin.read(4096)
-                    size += len(chunk)
-                    hasher.update(chunk)
-            md5 = hasher.hexdigest()
+            md5, size = _hash_file(outpath)
         else:
             headers = {
                 "user-agent": "Mozilla/5.0 (X11; Linux x86_64; rv:140.0) Gecko/20100101 Firefox/140.0",
             }
-            try:
-                r = requests.get(url, headers=headers, stream=True)
-                r.raise_for_status()
-            except Exception as e:
-                raise DownloadFailed() from e
+            r = _request_media(url, headers)
             mimetype = r.headers.get("content-type", None)
             if mimetype is None:
                 mimetype = guess_type(urlparse(url).path)[0]
             elif ";" in mimetype:
                 mimetype = mimetype[:mimetype.find(";")]
-            hasher = hashlib.md5()
+            try:
+                content_length = int(r.headers.get("content-length", 0))
+            except ValueError:
+                content_length = 0
+            if (options.max_file_size is not None) and (content_length > options.max_file_size):
+                r.close()
+                raise DownloadFailed("File too large: {} bytes".format(content_length))
+            hasher = new_md5()
             size = 0
-            with open(outpath, "wb") as fout:
-                for chunk in r.iter_content(chunk_size=4096):
-                    fout.write(chunk)
-                    hasher.update(chunk)
-                    size += len(chunk)
+            try:
+                with open(outpath, "wb", buffering=WRITE_BUFFER_SIZE) as fout:
+                    if content_length > 0:
+                        _preallocate(fout, content_length)
+                    # byte ranges refer to the encoded content, so only resume uncompressed responses
+                    can_resume = (r.headers.get("accept-ranges", None) == "bytes") and ("content-encoding" not in r.headers)
+                    n_resumes = 0
+                    # bound methods, to avoid the attribute lookups for each chunk
+                    write = fout.write
+                    update = hasher.update
+                    while True:
+                        try:
+                            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                                write(chunk)
+                                update(chunk)
+                                size += len(chunk)
+                                if (options.max_file_size is not None) and (size > options.max_file_size):
+                                    raise DownloadFailed("File too large: more than {} bytes".format(options.max_file_size))
+                            break
+                        except requests.RequestException as e:
+                            # connection lost during the download
+                            r.close()
+                            if (not can_resume) or (n_resumes >= HTTP_RETRIES):
+                                raise DownloadFailed("Connection lost during download") from e
+                            n_resumes += 1
+                            range_headers = dict(headers)
+                            range_headers["range"] = "bytes={}-".format(size)
+                            range_headers["accept-encoding"] = "identity"
+                            r = _request_media(url, range_headers)
+                            if (r.status_code != 206) or not r.headers.get("content-range", "").startswith("bytes {}-".format(size)):
+                                raise DownloadFailed("Server did not resume the download")
+                    # the preallocated size may differ from the actual size
+                    fout.truncate()
+            except DownloadFailed:
+                r.close()
+                os.remove(outpath)
+                raise
             md5 = hasher.hexdigest()
     except DownloadFailed:
-        mo = MediaFile(
-            url=unify_url(url),
-            downloaded=False,
-        )
-        session.add(mo)
-        session.commit()
-        return False
+        return DownloadResult(url=unified_url, downloaded=False)
+    return DownloadResult(
+        url=unified_url,
+        downloaded=True,
+        md5=md5,
+        mimetype=mimetype,
+        size=size,
+    )
 
-    existing_mf = session.execute(
-        select(MediaFile).where(
+
+def post_process_download(result, options):
+    """
+    Post-process a downloaded file.
+
+    This function does not access the database, so it can be used in
+    worker processes.
+
+    @param result: result of the download
+    @type result: L{DownloadResult}
+    @param options: options for the post-processing
+    @type options: L{DownloadOptions}
+    @return: the result with mimetype and size of the post-processed file
+    @rtype: L{DownloadResult}
+    """
+    mf = MediaFile(
+        url=result.url,
+        downloaded=True,
+        md5=result.md5,
+        mimetype=result.mimetype,
+        size=result.size,
+    )
+    post_process(
+        options.mediadir,
+        mf,
+        max_image_dimension=options.max_image_dimension,
+        ignore_errors=options.ignore_postprocessing_errors,
+    )
+    return DownloadResult(
+        url=mf.url,
+        downloaded=True,
+        md5=mf.md5,
+        mimetype=mf.mimetype,
+        size=mf.size,
+    )
+
+
+def find_primary_uid(session, md5):
+    """
+    Find the uid of the mediafile an identical file has already been downloaded for.
+
+    @param session: sqlalchemy session
+    @type session: L{sqlalchemy.orm.Session}
+    @param md5: md5 hexdigest of the file
+    @type md5: L{str}
+    @return: the uid of the primary mediafile or None if no such file has been downloaded
+    @rtype: L{int} or L{None}
+    """
+    return session.execute(
+        select(MediaFile.uid).where(
             MediaFile.md5 == md5,
             MediaFile.downloaded == True,
-            MediaFile.primary_uid is None,
-        )
-    ).one_or_none()
-    if existing_mf is not None:
-        # file already downloaded
-        os.remove(os.path.join(mediadir, url_hash))
-        mf = MediaFile(
-            url=unify_url(url),
-            downloaded=True,
-            md5=md5,
-            mimetype=mimetype,
-            primary_uid=existing_mf[0].uid,
-        )
-        session.add(mf)
+            MediaFile.primary_uid.is_(None),
+        ).limit(1)
+    ).scalar()
+
+
+def get_mediafile_insert(session):
+    """
+    Return an insert statement for mediafiles, skipping already known URLs.
+
+    Where supported by the database, this uses "ON CONFLICT DO NOTHING",
+    so that a single already known URL does not fail a whole batch.
+
+    @param session: sqlalchemy session
+    @type session: L{sqlalchemy.orm.Session}
+    @return: the insert statement
+    @rtype: L{sqlalchemy.sql.expression.Insert}
+    """
+    dialect_name = session.get_bind().dialect.name
+    if dialect_name == "sqlite":
+        return sqlite_insert(MediaFile).on_conflict_do_nothing(index_elements=["url"])
+    elif dialect_name == "postgresql":
+        return postgresql_insert(MediaFile).on_conflict_do_nothing(index_elements=["url"])
+    return insert(MediaFile)
+
+
+class MediaFileWriter(object):
+    """
+    This class buffers new mediafiles, inserting them in batches.
+
+    @ivar batch_size: number of mediafiles to insert at once
+    @type batch_size: L{int}
+    @ivar pending: values of the mediafiles not yet inserted
+    @type pending: L{list} of L{dict}
+    """
+    def __init__(self, batch_size=MEDIAFILE_WRITE_BATCH_SIZE):
+        """
+        The default constructor.
+
+        @param batch_size: number of mediafiles to insert at once
+        @type batch_size: L{int}
+        """
+        self.batch_size = batch_size
+        self.pending = []
+        # md5s of the pending downloaded files not referencing another file
+        self._pending_md5s = set()
+
+    def add(self, session, row):
+        """
+        Add a mediafile, inserting the pending mediafiles if the batch is full.
+
+        @param session: sqlalchemy session
+        @type session: L{sqlalchemy.orm.Session}
+        @param row: values of the mediafile
+        @type row: L{dict}
+        """
+        self.pending.append(row)
+        if row["downloaded"] and (row["primary_uid"] is None):
+            self._pending_md5s.add(row["md5"])
+        if len(self.pending) >= self.batch_size:
+            self.flush(session)
+
+    def has_pending_md5(self, md5):
+        """
+        Check if a downloaded file with the specified md5 has not yet been inserted.
+
+        @param md5: md5 hexdigest of the file
+        @type md5: L{str}
+        @return: whether such a file is pending
+        @rtype: L{bool}
+        """
+        return md5 in self._pending_md5s
+
+    def flush(self, session):
+        """
+        Insert all pending mediafiles and commit.
+
+        @param session: sqlalchemy session
+        @type session: L{sqlalchemy.orm.Session}
+        """
+        if not self.pending:
+            return
+        session.execute(get_mediafile_insert(session), self.pending)
         session.commit()
-        return False
+        self.pending = []
+        self._pending_md5s.clear()
+
+
+def record_download(session, result, mediadir, writer=None):
+    """
+    Store the result of a download in the database.
+
+    If the same file has already been downloaded from another URL, the
+    new file is removed and the mediafile references the existing one.
+
+    @param session: sqlalchemy session
+    @type session: L{sqlalchemy.orm.Session}
+    @param result: result of the download
+    @type result: L{DownloadResult}
+    @param mediadir: directory where files were downloaded too
+    @type mediadir: L{str}
+    @param writer: if specified, add the mediafile to this writer instead of inserting it immediately
+    @type writer: L{MediaFileWriter} or L{None}
+    @return: whether a new file was downloaded or not
+    @rtype: l{bool}
+    """
+    row = {
+        "url": result.url,
+        "downloaded": result.downloaded,
+        "md5": None,
+        "mimetype": None,
+        "size": None,
+        "primary_uid": None,
+    }
+    is_new = False
+    if result.downloaded:
+        if (writer is not None) and writer.has_pending_md5(result.md5):
+            # the existing file needs an uid
+            writer.flush(session)
+        row["md5"] = result.md5
+        row["mimetype"] = result.mimetype
+        primary_uid = find_primary_uid(session, result.md5)
+        if primary_uid is not None:
+            # file already downloaded
+            os.remove(os.path.join(mediadir, hash_unified_url(result.url)))
+            row["primary_uid"] = primary_uid
+        else:
+            row["size"] = result.size
+            is_new = True
+    if writer is not None:
+        writer.add(session, row)
     else:
-        mf = MediaFile(
-            url=unify_url(url),
-            downloaded=True,
-            md5=md5,
-            mimetype=mimetype,
-            size=size,
-        )
-        if enable_post_processing:
-            post_process(
-                mediadir,
-                mf,
-                max_image_dimension=max_image_dimension,
-                ignore_errors=ignore_postprocessing_errors,
-            )
-        session.add(mf)
+        session.execute(get_mediafile_insert(session), [row])
         session.commit()
-        return True
+    return is_new
+
+
+def download(
+    session,
+    url,
+    mediadir,
+    enable_post_processing=True,
+    download_videos=True,
+    max_image_dimension=512,
+    ignore_postprocessing_errors=False,
+):
+    """
+    Download the media at the specified URL.
+
+    @param session: sqlalchemy session
+    @type session: L{sqlalchemy.orm.Session}
+    @param url: url to download
+    @type url: L{str}
+    @param mediadir: directory where files should be downloaded too
+    @type mediadir: L{str}
+    @param enable_post_processing: whether post-processing should be applied
+    @type enable_post_processing: L{bool}
+    @param download_videos: whether videos should be downloaded
+    @type download_videos: L{bool}
+    @param max_image_dimension: how many pixels the wider side of an image may have at most
+    @type max_image_dimension: L{int}
+    @param ignore_postprocessing_errors: if nonzero, ignore postprocessing errors
+    @type ignore_postprocessing_errors: L{bool}
+    @return: whether the file was downloaded or not
+    @rtype: l{bool}
+    """
+    options = DownloadOptions(
+        mediadir=mediadir,
+        enable_post_processing=enable_post_processing,
+        download_videos=download_videos,
+        max_image_dimension=max_image_dimension,
+        ignore_postprocessing_errors=ignore_postprocessing_errors,
+    )
+    result = fetch_media(url, options)
+    if result is None:
+        return False
+    if result.downloaded and enable_post_processing and (find_primary_uid(session, result.md5) is None):
+        result = post_process_download(result, options)
+    return record_download(session, result, mediadir=mediadir)
+
+
+def _download_one(url, options, rate_limiter):
+    """
+    Download a single URL in a download worker.
+
+    @param url: url to download
+    @type url: L{str}
+    @param options: options for the download
+    @type options: L{DownloadOptions}
+    @param rate_limiter: rate limiter limiting the requests per host
+    @type rate_limiter: L{arcticzim.net.HostRateLimiter}
+    @return: the result of the download or None if the URL should not be downloaded
+    @rtype: L{DownloadResult} or L{None}
+    """
+    rate_limiter.wait(url)
+    return fetch_media(url, options)
+
+
+class DownloadPipeline(object):
+    """
+    This class downloads files and post-processes them in parallel.
+
+    The network bound downloads are performed in a thread pool, while
+    the CPU bound post-processing can be performed in a process pool.
+    All database access happens in the thread running the pipeline.
+
+    @ivar session: sqlalchemy session to use
+    @type session: L{sqlalchemy.orm.Session}
+    @ivar options: options for the downloads
+    @type options: L{DownloadOptions}
+    @ivar download_executor: executor to download files in
+    @type download_executor: L{concurrent.futures.Executor}
+    @ivar cpu_executor: executor to post-process files in, None to post-process in this thread
+    @type cpu_executor: L{concurrent.futures.Executor} or L{None}
+    @ivar max_pending_downloads: max number of downloads to submit at once
+    @type max_pending_downloads: L{int}
+    @ivar n_downloaded: number of new files downloaded so far
+    @type n_downloaded: L{int}
+    """
+    def __init__(self, session, options, download_executor, cpu_executor=None, max_pending_downloads=DEFAULT_PREFETCH_WINDOW):
+        """
+        The default constructor.
+
+        @param session: sqlalchemy session to use
+        @type session: L{sqlalchemy.orm.Session}
+        @param options: options for the downloads
+        @type options: L{DownloadOptions}
+        @param download_executor: executor to download files in
+        @type download_executor: L{concurrent.futures.Executor}
+        @param cpu_executor: executor to post-process files in, None to post-process in this thread
+        @type cpu_executor: L{concurrent.futures.Executor} or L{None}
+        @param max_pending_downloads: max number of downloads to submit at once
+        @type max_pending_downloads: L{int}
+        """
+        self.session = session
+        self.options = options
+        self.download_executor = download_executor
+        self.cpu_executor = cpu_executor
+        self.max_pending_downloads = max(1, max_pending_downloads)
+        self.n_downloaded = 0
+
+        self._rate_limiter = HostRateLimiter(options.sleep)
+        self._writer = MediaFileWriter()
+        self._downloads = set()
+        self._postprocessing = set()
+        # md5 -> results of identical files waiting for the first one to be post-processed
+        self._waiting = {}
+
+    def run(self, urls, bar=None):
+        """
+        Download the specified URLs.
+
+        @param urls: URLs to download
+        @type urls: iterable of L{str}
+        @param bar: if specified, update this progress bar for each download
+        @type bar: L{tqdm.tqdm} or L{None}
+        @return: the number of new files downloaded
+        @rtype: L{int}
+        """
+        try:
+            self._run(urls, bar=bar)
+        finally:
+            # store the results of all completed downloads
+            self._writer.flush(self.session)
+        return self.n_downloaded
+
+    def _run(self, urls, bar=None):
+        """
+        Download the specified URLs, without flushing the remaining mediafiles.
+
+        @param urls: URLs to download
+        @type urls: iterable of L{str}
+        @param bar: if specified, update this progress bar for each download
+        @type bar: L{tqdm.tqdm} or L{None}
+        """
+        url_iter = iter(urls)
+        while True:
+            while len(self._downloads) < self.max_pending_downloads:
+                url = next(url_iter, None)
+                if url is None:
+                    break
+                self._downloads.add(self.download_executor.submit(_download_one, url, self.options, self._rate_limiter))
+            if not (self._downloads or self._postprocessing):
+                break
+            done, _ = concurrent.futures.wait(
+                self._downloads | self._postprocessing,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                if future in self._downloads:
+                    self._downloads.remove(future)
+                    result = future.result()
+                    if result is not None:
+                        self._on_downloaded(result)
+                    if bar is not None:
+                        bar.update(1)
+                else:
+                    self._postprocessing.remove(future)
+                    self._on_postprocessed(future.result())
+
+    def _record(self, result):
+        """
+        Store the result of a download in the database.
 
+        @param result: result of the download
+        @type result: L{DownloadResult}
+        """
+        if record_download(self.session, result, mediadir=self.options.mediadir, writer=self._writer):
+            self.n_downloaded += 1
 
+    def _needs_post_processing(self, result):
+        """
+        Check whether a downloaded file needs to be post-processed.
+
+        Files which failed to download and files identical to an already
+        stored or pending file are not post-processed.
+
+        @param result: result of the download
+        @type result: L{DownloadResult}
+        @return: whether the file needs to be post-processed
+        @rtype: L{bool}
+        """
+        if not result.downloaded:
+            return False
+        if not self.options.enable_post_processing:
+            return False
+        if self._writer.has_pending_md5(result.md5):
+            return False
+        return (find_primary_uid(self.session, result.md5) is None)
+
+    def _on_downloaded(self, result):
+        """
+        Called when a download has been completed.
+
+        @param result: result of the download
+        @type result: L{DownloadResult}
+        """
+        if result.downloaded and (result.md5 in self._waiting):
+            # an identical file is currently being post-processed
+            self._waiting[result.md5].append(result)
+            return
+        if not self._needs_post_processing(result):
+            # nothing to post-process
+            self._record(result)
+            return
+        if self.cpu_executor is None:
+            self._record(post_process_download(result, self.options))
+            return
+        self._waiting[result.md5] = []
+        self._postprocessing.add(self.cpu_executor.submit(post_process_download, result, self.options))
+
+    def _on_postprocessed(self, result):
+        """
+        Called when a file has been post-processed.
+
+        @param result: result of the post-processing
+        @type result: L{DownloadResult}
+        """
+        self._record(result)
+        for duplicate in self._waiting.pop(result.md5, []):
+            self._record(duplicate)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_ytdlp_extractors():
+    """
+    Return the working yt-dlp extractors, excluding the generic one.
+
+    The extractors are only collected once, as creating a
+    L{yt_dlp.YoutubeDL} is expensive.
+
+    @return: the working extractors
+    @rtype: L{tuple}
+    """
+    with YoutubeDL(params={"allowed_extractors": ["default", "-generic"]}) as yt:
+        # TODO: private attribute access is probably a bad idea
+        return tuple(ie for ie in yt._ies.values() if ie.working())
+
+
+@functools.lru_cache(maxsize=YTDLP_URL_CACHE_SIZE)
 def is_ytdlp(url):
     """
     Check if the target url should be downloaded via yt-dlp.
@@ -237,11 +950,7 @@ def is_ytdlp(url):
         # use yt-dlp to retrieve (possibily deleted) reddit videos
         return True
     # check if yt-dlp accepts it
-    with YoutubeDL(params={"allowed_extractors": ["default", "-generic"]}) as yt:
-        for ie in yt._ies.values():  # TODO: private attribute access is probably a bad idea
-            if ie.suitable(url) and ie.working():
-                return True
-    return False
+    return any(ie.suitable(url) for ie in _get_ytdlp_extractors())
 
 
 def do_ytldp_download(url, mediadir, outpath):
@@ -257,7 +966,6 @@ def do_ytldp_download(url, mediadir, outpath):
     @return: the mimetype of the downloaded video
     @rtype: L{str}
     """
-    hashed_url = hash_url(url)
     params = {
         # TODO: change "worst" to smallest filesize
         "format": "worst/worstvideo+worstaudio",
@@ -265,16 +973,16 @@ def do_ytldp_download(url, mediadir, outpath):
     }
     with YoutubeDL(params=params) as yt:
         try:
-            yt.download(url)
+            info = yt.extract_info(url, download=True)
         except Exception as e:
             raise DownloadFailed("yt-dlp raised an exception when attempting to download video") from e
-    # todo: the following is probably inefficient for large file collections
-    for fname in os.listdir(mediadir):
-        if fname.startswith(hashed_url) and ("." in fname):
-            # the "." check serves replacement of older files
-            break
-    mimetype = guess_type(fname)[0] or "video/mp4"
-    shutil.move(os.path.join(mediadir, fname), outpath)
+        # the final path may differ from the template if formats were merged
+        requested_downloads = info.get("requested_downloads", None) or [{}]
+        path = requested_downloads[0].get("filepath", None) or yt.prepare_filename(info)
+    if not os.path.exists(path):
+        raise DownloadFailed("yt-dlp did not write the expected file '{}'".format(path))
+    mimetype = guess_type(path)[0] or "video/mp4"
+    shutil.move(path, outpath)
     return mimetype
 
 
@@ -361,8 +1069,11 @@ def get_urls_from_post(post, include_reddit_videos=True, include_external_videos
     """
     Return all URLs used in a post
 
+    Unless comments are included, the post may also be a row containing
+    the L{POST_MEDIA_COLUMNS}.
+
     @param post: post to get URLs from
-    @type post: L{arcticzim.db.models.Post}
+    @type post: L{arcticzim.db.models.Post} or L{sqlalchemy.engine.Row}
     @param include_reddit_videos: whether reddit videos should be included
     @type include_reddit_videos: L{bool}
     @param include_external_videos: whether non-reddit videos should be included
@@ -377,7 +1088,7 @@ def get_urls_from_post(post, include_reddit_videos=True, include_external_videos
         urls.append(post.url)
     if post.post_hint in ("hosted:video", ) and include_reddit_videos:
         if post.media_metadata is not None:
-            media_metadata = json.loads(post.media_metadata)
+            media_metadata = loads_json(post.media_metadata)
         else:
             media_metadata = {}
         if ("reddit_video" in media_metadata) and ("dash_url" in media_metadata["reddit_video"]):
@@ -395,7 +1106,7 @@ def get_urls_from_post(post, include_reddit_videos=True, include_external_videos
         ):
             urls.append(url)
     if post.is_gallery:
-        media_metadata = json.loads(post.media_metadata)
+        media_metadata = loads_json(post.media_metadata)
         if media_metadata:
             for img_data in media_metadata.values():
                 if ("s" in img_data) and ("u" in img_data["s"]):
@@ -421,21 +1132,17 @@ def get_media_urls_from_string(s, include_reddit_videos=True, include_external_v
     @return: a list of URLs found
     @rtype: L{list} of L{str}
     """
-    urls = get_urls_from_string(s)
     found_urls = []
-    for url in urls:
-        mimetype = guess_type(urlparse(url).path)[0]
-        if mimetype is None:
-            # no guess
-            continue
-        if mimetype.startswith("video/"):
+    for url in iter_urls_from_string(s):
+        extension = get_url_extension(url)
+        if extension in VIDEO_EXTENSIONS:
             if is_redvid(url):
                 if include_reddit_videos:
                     found_urls.append(url)
             elif is_ytdlp(url):
                 if include_external_videos:
                     found_urls.append(url)
-        elif mimetype.startswith("image/"):
+        elif extension in IMAGE_EXTENSIONS:
             found_urls.append(url)
     return found_urls
 
@@ -451,6 +1158,10 @@ def download_all(
     max_image_dimension=512,
     ignore_postprocessing_errors=False,
     dry=False,
+    n_workers=1,
+    prefetch_window=DEFAULT_PREFETCH_WINDOW,
+    cpu_workers=1,
+    max_file_size=None,
 ):
     """
     Download all files of posts.
@@ -459,7 +1170,7 @@ def download_all(
     @type session: L{sqlalchemy.orm.Session}
     @param mediadir: directory to store media in
     @type mediadir: L{str}
-    @param sleep: sleep time between downloads in seconds
+    @param sleep: min time between two downloads from the same host in seconds
     @type sleep: L{int} or L{float}
     @param download_reddit_videos: whether reddit videos should be downloaded
     @type download_reddit_videos: L{bool}
@@ -475,45 +1186,89 @@ def download_all(
     @type ignore_postprocessing_errors: L{bool}
     @param dry: if nonzero, do not actually download anything
     @type dry: L{bool}
+    @param n_workers: number of threads to download files in
+    @type n_workers: L{int}
+    @param prefetch_window: number of downloads queued per download worker
+    @type prefetch_window: L{int}
+    @param cpu_workers: number of processes to post-process files in
+    @type cpu_workers: L{int}
+    @param max_file_size: if specified, do not download files larger than this many bytes
+    @type max_file_size: L{int} or L{None}
     @return: the number of files downloaded
     @rtype: L{int}
     """
-    n_downloaded = 0
-    n = session.execute(select(func.count(Post.uid))).one()[0]
-    stmt = select(Post).options(
-        undefer(Post.url),
-        undefer(Post.selftext),
-        selectinload(Post.comments),
-        undefer(Post.comments, Comment.body),
-    ).execution_options(
-        yield_per=1000,
+    # collect the URLs to download first, as the database is also used for the results
+    to_download = []
+    # URLs whose download has already been attempted or which are already queued
+    seen = get_attempted_urls(session)
+
+    def add_urls(urls):
+        """
+        Queue the URLs not yet seen for download.
+
+        @param urls: URLs to add
+        @type urls: iterable of L{str}
+        """
+        for url in urls:
+            unified_url = unify_url(url)
+            if unified_url in seen:
+                continue
+            seen.add(unified_url)
+            to_download.append(unified_url)
+
+    # only select the required columns, no ORM objects are needed for this
+    stmt = select(*POST_MEDIA_COLUMNS).order_by(Post.uid).execution_options(yield_per=1000)
+    # max(uid) is a cheap estimate of the progress, unlike count()
+    max_uid = session.execute(select(func.max(Post.uid))).scalar() or 0
+    with tqdm.tqdm(desc="Searching posts", total=max_uid, unit="posts") as bar:
+        for partition in session.execute(stmt).partitions():
+            for row in partition:
+                add_urls(
+                    get_urls_from_post(
+                        row,
+                        include_reddit_videos=download_reddit_videos,
+                        include_external_videos=download_external_videos,
+                    ),
+                )
+            bar.update(partition[-1].uid - bar.n)
+    if include_comments:
+        stmt = select(Comment.uid, Comment.body).order_by(Comment.uid).execution_options(yield_per=1000)
+        max_uid = session.execute(select(func.max(Comment.uid))).scalar() or 0
+        with tqdm.tqdm(desc="Searching comments", total=max_uid, unit="comments") as bar:
+            for partition in session.execute(stmt).partitions():
+                for row in partition:
+                    add_urls(get_media_urls_from_string(row.body))
+                bar.update(partition[-1].uid - bar.n)
+    if dry:
+        return len(to_download)
+    # spread the downloads over the hosts, as the requests to each host are rate limited
+    to_download = interleave_by_host(to_download)
+
+    options = DownloadOptions(
+        mediadir=mediadir,
+        enable_post_processing=enable_post_processing,
+        download_videos=(download_external_videos or download_reddit_videos),
+        max_image_dimension=max_image_dimension,
+        ignore_postprocessing_errors=ignore_postprocessing_errors,
+        sleep=sleep,
+        max_file_size=max_file_size,
     )
-    for post in tqdm.tqdm(session.execute(stmt).scalars(), desc="Searching posts", total=n, unit="posts"):
-        urls = get_urls_from_post(
-            post,
-            include_reddit_videos=download_reddit_videos,
-            include_external_videos=download_external_videos,
-            include_comments=include_comments,
+    n_workers = max(1, n_workers)
+    if enable_post_processing and (cpu_workers > 1):
+        cpu_executor_context = concurrent.futures.ProcessPoolExecutor(max_workers=cpu_workers)
+    else:
+        cpu_executor_context = contextlib.nullcontext()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as download_executor, \
+            cpu_executor_context as cpu_executor, \
+            tqdm.tqdm(desc="Downloading files", total=len(to_download), unit="files") as bar:
+        pipeline = DownloadPipeline(
+            session=session,
+            options=options,
+            download_executor=download_executor,
+            cpu_executor=cpu_executor,
+            max_pending_downloads=n_workers * prefetch_window,
         )
-        urls = set([unify_url(url) for url in urls if not has_downloaded(session=session, url=url)])
-        if not urls:
-            continue
-        for url in tqdm.tqdm(urls, desc="downloading files for {}".format(post.id), total=len(urls), unit="files"):
-            if not dry:
-                did_download = download(
-                    session=session,
-                    url=url,
-                    mediadir=mediadir,
-                    enable_post_processing=enable_post_processing,
-                    download_videos=(download_external_videos or download_reddit_videos),
-                    max_image_dimension=max_image_dimension,
-                    ignore_postprocessing_errors=ignore_postprocessing_errors,
-                )
-                if did_download:
-                    n_downloaded += 1
-                time.sleep(sleep)
-            else:
-                n_downloaded += 1
+        n_downloaded = pipeline.run(to_download, bar=bar)
     return n_downloaded
 
 
@@ -660,8 +1415,8 @@ class MediaFileManager(object):
     @type images_enabled: L{bool}
     @ivar videos_enabled: if video links should be rewritten
     @type videos_enabled: L{bool}
-    @ivar referenced_files: a list of files referenced by the rewritten URLs
-    @type referenced_files: L{list} of L{int}
+    @ivar referenced_files: the files referenced by the rewritten URLs
+    @type referenced_files: L{set} of L{int}
     """
     def __init__(self, session, enabled=True, images_enabled=True, videos_enabled=True):
         """
@@ -680,13 +1435,16 @@ class MediaFileManager(object):
         self.enabled = enabled
         self.images_enabled = images_enabled
         self.videos_enabled = videos_enabled
-        self.referenced_files = []
+        self.referenced_files = set()
+        # unified URL -> uid of file to use or None, see resolve_urls()
+        self._resolve_cache = {}
 
     def reset(self):
         """
         Reset internal states.
         """
-        self.referenced_files = []
+        self.referenced_files = set()
+        self._resolve_cache = {}
 
     def should_rewrite(self, mediafile):
         """
@@ -701,14 +1459,95 @@ class MediaFileManager(object):
         @return: whether the link should be rewritten
         @rtype: L{str}
         """
+        return self._should_rewrite_mimetype(mediafile.mimetype)
+
+    def _should_rewrite_mimetype(self, mimetype):
+        """
+        Check whether an URL to a file with the specified mimetype should be rewritten.
+
+        @param mimetype: mimetype of the file
+        @type mimetype: L{str} or L{None}
+        @return: whether the link should be rewritten
+        @rtype: L{str}
+        """
         if not self.enabled:
             return False
-        if mimetype_is_image(mediafile.mimetype) and self.images_enabled:
+        if mimetype_is_image(mimetype) and self.images_enabled:
             return True
-        if mimetype_is_video(mediafile.mimetype) and self.videos_enabled:
+        if mimetype_is_video(mimetype) and self.videos_enabled:
             return True
         return False
 
+    def resolve_urls(self, unified_urls):
+        """
+        Find the local files for the specified URLs.
+
+        All URLs not yet resolved since the last L{reset} are resolved
+        using batched IN queries. Duplicates are resolved to their primary files.
+
+        @param unified_urls: unified URLs to resolve
+        @type unified_urls: iterable of L{str}
+        @return: a dict mapping each unified URL that can be rewritten to the uid of the file to use
+        @rtype: L{dict} of L{str} -> L{int}
+        """
+        unified_urls = set(unified_urls)
+        unified_urls.discard("")
+        missing = unified_urls.difference(self._resolve_cache.keys())
+        if missing:
+            self._resolve_cache.update(self._query_urls(missing))
+        resolved = {}
+        for url in unified_urls:
+            uid = self._resolve_cache[url]
+            if uid is not None:
+                resolved[url] = uid
+        return resolved
+
+    def warm_up(self, urls):
+        """
+        Resolve the specified URLs in advance.
+
+        This resolves all URLs using batched queries, so that rewriting
+        them later does not require one query per URL.
+
+        @param urls: URLs that will be rewritten
+        @type urls: iterable of L{str}
+        """
+        if not self.enabled:
+            # no URLs will be rewritten
+            return
+        self.resolve_urls(unify_url(url) for url in urls)
+
+    def _query_urls(self, unified_urls):
+        """
+        Query the local files for the specified URLs.
+
+        This is a helper method for L{resolve_urls}.
+
+        @param unified_urls: unified URLs to resolve
+        @type unified_urls: L{set} of L{str}
+        @return: a dict mapping each unified URL to the uid of the file to use or None
+        @rtype: L{dict} of L{str} -> L{int} or L{None}
+        """
+        primary = aliased(MediaFile)
+        resolved = dict.fromkeys(unified_urls)
+        # limit the number of bound parameters per query
+        for batch in chunked(unified_urls, IN_QUERY_BATCH_SIZE):
+            stmt = select(
+                MediaFile.url,
+                func.coalesce(primary.uid, MediaFile.uid),
+                func.coalesce(primary.downloaded, MediaFile.downloaded),
+                func.coalesce(primary.mimetype, MediaFile.mimetype),
+            ).outerjoin(
+                primary,
+                MediaFile.primary_uid == primary.uid,
+            ).where(
+                MediaFile.url.in_(batch),
+            )
+            for url, uid, downloaded, mimetype in self.session.execute(stmt):
+                if downloaded and self._should_rewrite_mimetype(mimetype):
+                    resolved[url] = uid
+        return resolved
+
     def rewrite_url(self, url, to_root):
         """
         Rewrites an external URL to an internal one if the file exists locally.
@@ -721,24 +1560,12 @@ class MediaFileManager(object):
         @rtype: L{str}
         """
         unified_url = unify_url(url)
-        if not unified_url:
-            # we should not rewrite empty URLs
+        uid = self.resolve_urls([unified_url]).get(unified_url, None)
+        if uid is None:
+            # file not available or should not be used, can't rewrite
             return url
-        mf = self.session.execute(select(MediaFile).where(MediaFile.url == unified_url)).one_or_none()
-        if mf is None:
-            # file not downloaded, can't rewrite
-            return url
-        mf = mf[0]
-        if mf.primary_uid is not None:
-            mf = mf.primary
-        if not mf.downloaded:
-            # file not downloaded, can't rewrite
-            return url
-        if not self.should_rewrite(mf):
-            # we should not use this media file
-            return url
-        new_url = "{}/media/{}".format(to_root, mf.uid)
-        self.referenced_files.append(mf.uid)
+        new_url = "{}/media/{}".format(to_root, uid)
+        self.referenced_files.add(uid)
         return new_url
 
     def rewrite_urls_in_text(self, text, to_root):
@@ -753,11 +1580,22 @@ class MediaFileManager(object):
         @rtype: L{str}
         """
         urls = get_media_urls_from_string(text)
+        if not urls:
+            return text
+        unified_urls = {url: unify_url(url) for url in urls}
+        resolved = self.resolve_urls(unified_urls.values())
+        replacements = {}
         for url in urls:
-            new_url = self.rewrite_url(url, to_root=to_root)
-            if new_url != url:
-                text = text.replace(url, new_url)
-        return text
+            uid = resolved.get(unified_urls[url], None)
+            if uid is None:
+                continue
+            replacements[url] = "{}/media/{}".format(to_root, uid)
+            self.referenced_files.add(uid)
+        if not replacements:
+            return text
+        # the URL pattern matches exactly the URLs found above, so no
+        # pattern has to be compiled for the replacements
+        return URL.sub(lambda m: replacements.get(m.group(0), m.group(0)), text)
 
     def is_media_locally_available(self, url):
         """
@@ -769,20 +1607,4 @@ class MediaFileManager(object):
         @rtype: L{bool}
         """
         unified_url = unify_url(url)
-        if not unified_url:
-            # empty url - not locally available
-            return False
-        mf = self.session.execute(select(MediaFile).where(MediaFile.url == unified_url)).one_or_none()
-        if mf is None:
-            # file not downloaded, thus not available
-            return False
-        mf = mf[0]
-        if mf.primary_uid is not None:
-            mf = mf.primary
-        if not mf.downloaded:
-            # file not downloaded, thus not available
-            return False
-        if not self.should_rewrite(mf):
-            # we should not use this media file
-            return False
-        return True
+        return unified_url in self.resolve_urls([unified_url])
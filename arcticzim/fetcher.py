@@ -2,16 +2,16 @@
 This module handles the fetching of additional data like wiki pages.
 """
 import time
-import datetime
+import functools
 
-import requests
 from sqlalchemy import select, func
-from sqlalchemy.orm import undefer
 import tqdm
 
 from .db.models import Subreddit, Post, WikiPage, SubredditRule
-from .importer import import_posts, import_comments
-from .util import get_urls_from_string, parse_reddit_url
+from .importer import import_posts, import_comments, bulk_insert
+from .net import get_http_session, format_api_timestamp, HostRateLimiter, API_TIMEOUT
+from .jsonl import loads_json
+from .util import URL, iter_urls_from_string, parse_reddit_url, may_contain_reddit_urls
 
 
 def reddit_reference_to_url(reference, to_root):
@@ -41,14 +41,18 @@ def get_reddit_references_from_post(post):
     """
     Return all reddit references contained in a post.
 
+    The post may also be a row containing the id, url and selftext
+    columns.
+
     @param post: post to get references from
-    @type post: L{arcticzim.db.models.Post}
+    @type post: L{arcticzim.db.models.Post} or L{sqlalchemy.engine.Row}
     @return: all references in the post, like L{parse_reddit_url}
     @rtype: L{list} of L{dict}
     """
     # get all URLs
     urls = [post.url]
-    urls += get_urls_from_string(post.selftext)
+    if may_contain_reddit_urls(post.selftext):
+        urls.extend(iter_urls_from_string(post.selftext))
     # find references
     references = [parse_reddit_url(url) for url in urls]
     references = [r for r in references if r is not None]
@@ -66,10 +70,10 @@ def get_reddit_references_from_text(s):
     @return: all references in the post, like L{parse_reddit_url}
     @rtype: L{list} of L{dict}
     """
-    # get all URLs
-    urls = get_urls_from_string(s)
-    # find references
-    references = [parse_reddit_url(url) for url in urls]
+    if not may_contain_reddit_urls(s):
+        return []
+    # find references in all URLs
+    references = [parse_reddit_url(url) for url in iter_urls_from_string(s)]
     references = [r for r in references if r is not None]
     return references
 
@@ -102,69 +106,81 @@ def has_subreddit_locally(session, subreddit_name):
     return (subreddit is not None)
 
 
-def fetch_all_references(session, sleep=1):
+def _add_referenced_post_ids(references, referenced_post_ids):
+    """
+    Add the ids of the posts referenced by the specified references.
+
+    This is a helper function for L{fetch_all_references}.
+
+    @param references: references, like L{parse_reddit_url}
+    @type references: L{list} of L{dict}
+    @param referenced_post_ids: dict whose keys are the referenced post ids, will be updated
+    @type referenced_post_ids: L{dict}
+    """
+    for reference in references:
+        if reference["type"] in ("post", "comment"):
+            # a dict is used as an ordered set
+            referenced_post_ids[reference["post"]] = None
+
+
+def fetch_all_references(session, sleep=1, fetch_size=1000, executor=None, rate_limiter=None):
     """
     Fetch all referenced objects, be it from crossposts or wiki references.
 
+    This first collects the ids of all referenced posts, then fetches
+    those referenced posts which do not exist locally.
+
     @param session: sqlalchemy session to use
     @type session: L{sqlalchemy.orm.Session}
     @param sleep: how many seconds to wait between requests
     @type sleep: L{str}
+    @param fetch_size: number of rows to fetch at once when searching for references
+    @type fetch_size: L{int}
+    @param executor: if specified, fetch the referenced posts in this executor
+    @type executor: L{concurrent.futures.Executor} or L{None}
+    @param rate_limiter: if specified, rate limiter shared with other fetch operations to use instead of sleep
+    @type rate_limiter: L{arcticzim.net.HostRateLimiter} or L{None}
     @return: whether anything new has been fetched
     @rtype: L{bool}
     """
-    did_fetch_something_new = False
+    # ids of all posts existing locally
+    local_post_ids = set()
+    referenced_post_ids = {}
+    # only select the required columns, no ORM objects are needed for this
+    # yield_per implies streaming the results
     # posts
     n = session.execute(select(func.count(Post.uid))).one()[0]
-    stmt = select(Post).options(
-        undefer(Post.url),
-        undefer(Post.selftext),
-    ).execution_options(
-        yield_per=1000,
+    stmt = select(Post.id, Post.url, Post.selftext).execution_options(
+        yield_per=fetch_size,
     )
-    for post in tqdm.tqdm(session.execute(stmt).scalars(), desc="Searching in posts and fetching results...", total=n, unit="posts"):
-        references = get_reddit_references_from_post(
-            post,
-        )
-        references = [
-            e
-            for e in references
-            if (e["type"] in ("post", "comment")) and not has_post_locally(session=session, postid=e["post"])
-        ]
-        if not references:
-            continue
-        for reference in tqdm.tqdm(references, desc="Fetching referenced objects for {}".format(post.id), total=len(references), unit="obj"):
-            if reference["type"] in ("post", "comment"):
-                if not has_post_locally(session, postid=reference["post"]):
-                    # we need a second check in case the same post referenced the same post multiple times
-                    fetch_post(session=session, postid=reference["post"], sleep=sleep)
-                    did_fetch_something_new = True
-            time.sleep(sleep)
+    for post in tqdm.tqdm(session.execute(stmt), desc="Searching for references in posts", total=n, unit="posts"):
+        local_post_ids.add(post.id)
+        _add_referenced_post_ids(get_reddit_references_from_post(post), referenced_post_ids)
     # wikipages
     n = session.execute(select(func.count(WikiPage.uid))).one()[0]
-    stmt = select(WikiPage).options(
-        undefer(WikiPage.content),
-    ).execution_options(
-        yield_per=1000,
+    stmt = select(WikiPage.subreddit_name, WikiPage.path, WikiPage.content).execution_options(
+        yield_per=fetch_size,
     )
-    for wikipage in tqdm.tqdm(session.execute(stmt).scalars(), desc="Searching in wikipages and fetching results...", total=n, unit="posts"):
-        references = get_reddit_references_from_text(
-            wikipage.content,
-        )
-        references = [
-            e
-            for e in references
-            if (e["type"] in ("post", "comment")) and not has_post_locally(session=session, postid=e["post"])
-        ]
-        if not references:
-            continue
-        for reference in tqdm.tqdm(references, desc="Fetching referenced objects for {}/wiki/{}".format(wikipage.subreddit_name, wikipage.basepath), total=len(references), unit="obj"):
-            if reference["type"] in ("post", "comment"):
-                if not has_post_locally(session, postid=reference["post"]):
-                    # we need a second check in case the same post referenced the same post multiple times
-                    fetch_post(session=session, postid=reference["post"], sleep=sleep)
-                    did_fetch_something_new = True
-            time.sleep(sleep)
+    for wikipage in tqdm.tqdm(session.execute(stmt), desc="Searching for references in wikipages", total=n, unit="pages"):
+        _add_referenced_post_ids(get_reddit_references_from_text(wikipage.content), referenced_post_ids)
+    # as all posts have been scanned, the missing posts are simply the difference
+    missing = [postid for postid in referenced_post_ids if postid not in local_post_ids]
+    if not missing:
+        return False
+    # the requests may run in the executor while the results are imported here
+    # progress bars of parallel requests would garble each other
+    results = _map_requests(
+        functools.partial(get_post_data, progress=(executor is None)),
+        missing,
+        sleep=sleep,
+        executor=executor,
+        rate_limiter=rate_limiter,
+    )
+    did_fetch_something_new = False
+    for postid, (raw_posts, raw_comments) in tqdm.tqdm(results, desc="Fetching referenced posts", total=len(missing), unit="posts"):
+        # deleted or unarchived posts can not be fetched
+        if _import_post_data(session, raw_posts, raw_comments):
+            did_fetch_something_new = True
     return did_fetch_something_new
 
 
@@ -179,35 +195,93 @@ def fetch_post(session, postid, sleep=1):
     @param sleep: time to sleep between each request, in seconds
     @type sleep: L{int} or L{float}
     """
+    raw_posts, raw_comments = get_post_data(postid, sleep=sleep)
+    _import_post_data(session, raw_posts, raw_comments)
+
+
+def _import_post_data(session, raw_posts, raw_comments):
+    """
+    Insert the data returned by L{get_post_data} into the database.
+
+    @param session: sqlalchemy session to use
+    @type session: L{sqlalchemy.orm.Session}
+    @param raw_posts: the raw posts to import
+    @type raw_posts: L{list} of L{dict}
+    @param raw_comments: the raw comments to import
+    @type raw_comments: L{list} of L{dict}
+    @return: whether anything has been imported
+    @rtype: L{bool}
+    """
+    if not raw_posts:
+        return False
+    import_posts(session, raw_posts)
+    import_comments(session, raw_comments)
+    return True
+
+
+def _get_api_json(url, rate_limiter=None):
+    """
+    Perform a request to the Arctic Shift API and return the parsed response.
+
+    @param url: url to request
+    @type url: L{str}
+    @param rate_limiter: if specified, wait for this rate limiter before the request
+    @type rate_limiter: L{arcticzim.net.HostRateLimiter} or L{None}
+    @return: the parsed response
+    @rtype: L{dict}
+    """
+    if rate_limiter is not None:
+        rate_limiter.wait(url)
+    r = get_http_session().get(url, timeout=API_TIMEOUT)
+    r.raise_for_status()
+    return loads_json(r.content)
+
+
+def get_post_data(postid, sleep=1, rate_limiter=None, progress=True):
+    """
+    Fetch a post and its comments from Arctic Shift and return them.
+
+    This function does not access the database, so it can be used in
+    worker threads.
+
+    @param postid: id of post to fetch
+    @type postid: L{str}
+    @param sleep: time to sleep between each request, in seconds, ignored if rate_limiter is specified
+    @type sleep: L{int} or L{float}
+    @param rate_limiter: if specified, rate limiter shared with other threads to use instead of sleep
+    @type rate_limiter: L{arcticzim.net.HostRateLimiter} or L{None}
+    @param progress: whether to show a progress bar for the comments
+    @type progress: L{bool}
+    @return: a tuple of (raw posts, raw comments), both empty if the post was not found
+    @rtype: L{tuple} of (L{list} of L{dict}, L{list} of L{dict})
+    """
+    if rate_limiter is None:
+        rate_limiter = HostRateLimiter(sleep)
     # fetch the post
     url = "https://arctic-shift.photon-reddit.com/api/posts/ids?ids={}".format(postid)
-    r = requests.get(url)
-    r.raise_for_status()
-    json = r.json()
+    json = _get_api_json(url, rate_limiter)
     if ("data" not in json) or (len(json["data"]) == 0):
-        return
-    import_posts(session, json["data"])
+        return ([], [])
+    raw_posts = json["data"]
     # fetch the comments
     start = int(json["data"][0].get("created_utc", 0))
     end = int(time.time())
     timestamp = start
     if timestamp > 0:
-        timestamp - 100  # just to be sure we fetch all data
+        timestamp -= 100  # just to be sure we fetch all data
     raw_comments = []
     with tqdm.tqdm(
         desc="Fetching comments for {}".format(postid),
         total=(end - start),
         unit="seconds",
+        disable=not progress,
     ) as bar:
         while True:
-            time.sleep(sleep)
             comment_url = "https://arctic-shift.photon-reddit.com/api/comments/search?link_id={}&sort=asc&after={}&limit=auto".format(
                 postid,
-                datetime.datetime.fromtimestamp(timestamp).isoformat(),
+                format_api_timestamp(timestamp),
             )
-            r = requests.get(comment_url)
-            r.raise_for_status()
-            json = r.json()
+            json = _get_api_json(comment_url, rate_limiter)
             if ("data" not in json) or (len(json["data"]) == 0):
                 break
             raw_comments += json["data"]
@@ -221,33 +295,33 @@ def fetch_post(session, postid, sleep=1):
             timestamp = new_timestamp
             bar.n = int(timestamp - start)
         bar.n = int(end - start)
-        import_comments(session, raw_comments)
+    return (raw_posts, raw_comments)
 
 
-def get_wikipages_for_subreddit(subreddit_name):
+def get_wikipages_for_subreddit(subreddit_name, rate_limiter=None):
     """
     Fetch wiki pages for a specific subreddit and return them.
 
     @param subreddit_name: name of subreddit to fetch wikipages for
     @type subreddit_name: L{str}
-    @return: a list of wiki pages
-    @rtype: L{list} of L{arcticzim.db.models.WikiPage}
+    @param rate_limiter: if specified, wait for this rate limiter before the request
+    @type rate_limiter: L{arcticzim.net.HostRateLimiter} or L{None}
+    @return: a list of rows for L{arcticzim.db.models.WikiPage}
+    @rtype: L{list} of L{dict}
     """
     url = "https://arctic-shift.photon-reddit.com/api/subreddits/wikis?subreddit={}&limit=100".format(subreddit_name)
-    r = requests.get(url)
-    r.raise_for_status()
-    rawpages = r.json()["data"]
+    rawpages = _get_api_json(url, rate_limiter)["data"]
     pages = []
     for rawpage in rawpages:
-        page = WikiPage(
-            subreddit_name=subreddit_name,
-            path=rawpage["path"],
-            content=rawpage.get("content", "[page empty or content not available]"),
-            revision_date=rawpage.get("revision_date", 0),
-            revision_author=rawpage.get("revision_author", None) or "[Author unknown]",
-            revision_reason=rawpage.get("revision_reason", None),
-            retrieved_on=rawpage.get("retrieved_on", 0),
-        )
+        page = {
+            "subreddit_name": subreddit_name,
+            "path": rawpage["path"],
+            "content": rawpage.get("content", "[page empty or content not available]"),
+            "revision_date": rawpage.get("revision_date", 0),
+            "revision_author": rawpage.get("revision_author", None) or "[Author unknown]",
+            "revision_reason": rawpage.get("revision_reason", None),
+            "retrieved_on": rawpage.get("retrieved_on", 0),
+        }
         pages.append(page)
     return pages
 
@@ -263,16 +337,11 @@ def fetch_wiki_for_subreddit(session, subreddit_name):
     @return: whether anything new has been fetched
     @rtype: L{bool}
     """
-    did_fetch_something = False
     pages = get_wikipages_for_subreddit(subreddit_name)
-    for page in pages:
-        session.merge(page)
-        did_fetch_something = True
-    session.commit()
-    return did_fetch_something
+    return _store_fetched(session, WikiPage, pages)
 
 
-def fetch_all_wikis(session, sleep=1):
+def fetch_all_wikis(session, sleep=1, executor=None, rate_limiter=None):
     """
     Fetch all wiki pages and insert them into the database.
 
@@ -280,47 +349,51 @@ def fetch_all_wikis(session, sleep=1):
     @type session: L{sqlalchemy.orm.Session}
     @param sleep: how many seconds to wait between each request
     @type sleep: L{int}
+    @param executor: if specified, perform the requests in this executor
+    @type executor: L{concurrent.futures.Executor} or L{None}
+    @param rate_limiter: if specified, rate limiter shared with other fetch operations to use instead of sleep
+    @type rate_limiter: L{arcticzim.net.HostRateLimiter} or L{None}
     @return: whether anything new has been fetched
     @rtype: L{bool}
     """
     did_fetch_something_new = False
-    stmt = select(Subreddit).where(~Subreddit.wikipages.any())
-    for subreddit in session.execute(stmt).scalars():
-        print("Fetching wikipages for: {}".format(subreddit.name))
-        if fetch_wiki_for_subreddit(session, subreddit.name):
+    stmt = select(Subreddit.name).where(~Subreddit.wikipages.any())
+    subreddit_names = session.execute(stmt).scalars().all()
+    for subreddit_name, pages in _map_requests(get_wikipages_for_subreddit, subreddit_names, sleep=sleep, executor=executor, rate_limiter=rate_limiter):
+        print("Fetched wikipages for: {}".format(subreddit_name))
+        if _store_fetched(session, WikiPage, pages):
             did_fetch_something_new = True
-        time.sleep(sleep)
     return did_fetch_something_new
 
 
-def get_rules_for_subreddit(subreddit_name):
+def get_rules_for_subreddit(subreddit_name, rate_limiter=None):
     """
     Fetch the rules for a specific subreddit and return them.
 
     @param subreddit_name: name of subreddit to fetch rules for
     @type subreddit_name: L{str}
-    @return: a list of subreddit rules
-    @rtype: L{list} of L{arcticzim.db.models.SubredditRule}
+    @param rate_limiter: if specified, wait for this rate limiter before the request
+    @type rate_limiter: L{arcticzim.net.HostRateLimiter} or L{None}
+    @return: a list of rows for L{arcticzim.db.models.SubredditRule}
+    @rtype: L{list} of L{dict}
     """
     url = "https://arctic-shift.photon-reddit.com/api/subreddits/rules?subreddits={}".format(subreddit_name)
-    r = requests.get(url)
-    r.raise_for_status()
-    all_rawrules = r.json()["data"]
+    all_rawrules = _get_api_json(url, rate_limiter)["data"]
     if not all_rawrules:
         # no rules for subreddits (found)
         return []
     rawrules = all_rawrules[0]["rules"]
     rules = []
     for rawrule in rawrules:
-        rule = SubredditRule(
-            subreddit_name=subreddit_name,
-            kind=rawrule["kind"],
-            priority=rawrule["priority"],
-            short_name=rawrule["short_name"],
-            created_utc=rawrule["created_utc"],
-            description=rawrule["description"],
-            violation_reason=rawrule.get("violation_reason", ""),
-        )
+        rule = {
+            "subreddit_name": subreddit_name,
+            "kind": rawrule["kind"],
+            "priority": rawrule["priority"],
+            "short_name": rawrule["short_name"],
+            "created_utc": rawrule["created_utc"],
+            "description": rawrule["description"],
+            "violation_reason": rawrule.get("violation_reason", ""),
+        }
         rules.append(rule)
     return rules
 
@@ -336,16 +409,11 @@ def fetch_rules_for_subreddit(session, subreddit_name):
     @return: whether anything new has been fetched
     @rtype: L{bool}
     """
-    did_fetch_something = False
     rules = get_rules_for_subreddit(subreddit_name)
-    for rule in rules:
-        session.merge(rule)
-        did_fetch_something = True
-    session.commit()
-    return did_fetch_something
+    return _store_fetched(session, SubredditRule, rules)
 
 
-def fetch_all_rules(session, sleep=1):
+def fetch_all_rules(session, sleep=1, executor=None, rate_limiter=None):
     """
     Fetch all rules and insert them into the database.
 
@@ -353,20 +421,80 @@ def fetch_all_rules(session, sleep=1):
     @type session: L{sqlalchemy.orm.Session}
     @param sleep: how many seconds to wait between each request
     @type sleep: L{int}
+    @param executor: if specified, perform the requests in this executor
+    @type executor: L{concurrent.futures.Executor} or L{None}
+    @param rate_limiter: if specified, rate limiter shared with other fetch operations to use instead of sleep
+    @type rate_limiter: L{arcticzim.net.HostRateLimiter} or L{None}
     @return: whether anything new has been fetched
     @rtype: L{bool}
     """
     did_fetch_something_new = False
-    stmt = select(Subreddit).where(~Subreddit.rules.any())
-    for subreddit in session.execute(stmt).scalars():
-        print("Fetching rules for: {}".format(subreddit.name))
-        if fetch_rules_for_subreddit(session, subreddit.name):
+    stmt = select(Subreddit.name).where(~Subreddit.rules.any())
+    subreddit_names = session.execute(stmt).scalars().all()
+    for subreddit_name, rules in _map_requests(get_rules_for_subreddit, subreddit_names, sleep=sleep, executor=executor, rate_limiter=rate_limiter):
+        print("Fetched rules for: {}".format(subreddit_name))
+        if _store_fetched(session, SubredditRule, rules):
             did_fetch_something_new = True
-        time.sleep(sleep)
     return did_fetch_something_new
 
 
-def fetch_all(session, sleep=1, with_references=True):
+def _store_fetched(session, model, rows):
+    """
+    Insert fetched rows into the database.
+
+    All rows are inserted using a single bulk insert.
+
+    @param session: sqlalchemy session to use
+    @type session: L{sqlalchemy.orm.Session}
+    @param model: model whose table the rows should be inserted into
+    @type model: L{arcticzim.db.models.Base} subclass
+    @param rows: values of the rows to insert
+    @type rows: L{list} of L{dict}
+    @return: whether anything new has been inserted
+    @rtype: L{bool}
+    """
+    if not rows:
+        return False
+    bulk_insert(session, model, rows)
+    session.commit()
+    return True
+
+
+def _map_requests(f, args, sleep=1, executor=None, rate_limiter=None):
+    """
+    Call a function performing requests for each argument.
+
+    The function must not access the database, as it may be called in
+    another thread. It must accept a rate_limiter keyword argument,
+    which is shared by all calls so that the rate limit also applies
+    when the requests are performed in parallel. The results are
+    returned in order.
+
+    @param f: function to call
+    @type f: callable
+    @param args: arguments to call the function with
+    @type args: L{list}
+    @param sleep: min time between two requests in seconds
+    @type sleep: L{int}
+    @param executor: if specified, perform the requests in this executor
+    @type executor: L{concurrent.futures.Executor} or L{None}
+    @param rate_limiter: if specified, rate limiter shared with other fetch operations to use instead of sleep
+    @type rate_limiter: L{arcticzim.net.HostRateLimiter} or L{None}
+    @yields: tuples of (arg, result)
+    @ytype: L{tuple}
+    """
+    if rate_limiter is None:
+        rate_limiter = HostRateLimiter(sleep)
+    f = functools.partial(f, rate_limiter=rate_limiter)
+    if executor is None:
+        for arg in args:
+            yield (arg, f(arg))
+    else:
+        results = executor.map(f, args)
+        yield from zip(args, results)
+
+
+def fetch_all(session, sleep=1, with_references=True, fetch_size=1000, executor=None, rate_limiter=None):
     """
     Run all fetch operations.
 
@@ -376,13 +504,29 @@ def fetch_all(session, sleep=1, with_references=True):
     @type sleep: L{int}
     @param with_references: wether referenced reddit pages (e.g. posts) should also be fetched
     @type with_references: L{bool}
+    @param fetch_size: number of rows to fetch at once when searching for references
+    @type fetch_size: L{int}
+    @param executor: if specified, perform independent requests in this executor
+    @type executor: L{concurrent.futures.Executor} or L{None}
+    @param rate_limiter: if specified, rate limiter shared with other fetch rounds to use instead of sleep
+    @type rate_limiter: L{arcticzim.net.HostRateLimiter} or L{None}
     @return: whether anything new has been fetched
     @rtype: L{bool}
     """
-    did_fetch_wiki = fetch_all_wikis(session, sleep=sleep)
-    did_fetch_rule = fetch_all_rules(session, sleep=sleep)
+    if rate_limiter is None:
+        # all requests share a single rate limit
+        rate_limiter = HostRateLimiter(sleep)
+    did_fetch_wiki = fetch_all_wikis(session, sleep=sleep, executor=executor, rate_limiter=rate_limiter)
+    did_fetch_rule = fetch_all_rules(session, sleep=sleep, executor=executor, rate_limiter=rate_limiter)
+    did_fetch_post = False
     if with_references:
-        did_fetch_post = fetch_all_references(session, sleep=sleep)
+        did_fetch_post = fetch_all_references(
+            session,
+            sleep=sleep,
+            fetch_size=fetch_size,
+            executor=executor,
+            rate_limiter=rate_limiter,
+        )
     return any((did_fetch_wiki, did_fetch_rule, did_fetch_post))
 
 
@@ -393,28 +537,54 @@ class ReferenceUrlRewriter(object):
     @ivar session: sqlalchemy session to use
     @type session: L{sqlalchemy.orm.Session}
     """
-    def __init__(self, session):
+    def __init__(self, session, preload=True):
         """
         The default constructor.
 
         @param session: sqlalchemy session to use
         @type session: L{sqlalchemy.orm.Session}
+        @param preload: if nonzero, load the ids of all posts and subreddits now instead of querying them when needed
+        @type preload: L{bool}
         """
         self.session = session
+        # post id/subreddit name -> whether it exists locally
+        self._post_cache = {}
+        self._subreddit_cache = {}
+        if preload:
+            self._post_ids = frozenset(
+                session.execute(select(Post.id).execution_options(yield_per=10000)).scalars(),
+            )
+            self._subreddit_names = frozenset(session.execute(select(Subreddit.name)).scalars())
+        else:
+            self._post_ids = None
+            self._subreddit_names = None
 
     def should_rewrite(self, reference):
         """
         Check if a reference should be rewritten.
 
+        Unless the ids have been preloaded, the results are cached, as
+        the database is not modified while building.
+
         @param reference: reference to check
         @type reference: L{dict}
         @return: whether the reference should be rewritten or not
         @rtype: L{bool}
         """
         if reference["type"] in ("post", "comment"):
-            return has_post_locally(self.session, reference["post"])
+            postid = reference["post"]
+            if self._post_ids is not None:
+                return postid in self._post_ids
+            if postid not in self._post_cache:
+                self._post_cache[postid] = has_post_locally(self.session, postid)
+            return self._post_cache[postid]
         elif reference["type"] == "subreddit":
-            return has_subreddit_locally(self.session, reference["subreddit"])
+            subreddit_name = reference["subreddit"]
+            if self._subreddit_names is not None:
+                return subreddit_name in self._subreddit_names
+            if subreddit_name not in self._subreddit_cache:
+                self._subreddit_cache[subreddit_name] = has_subreddit_locally(self.session, subreddit_name)
+            return self._subreddit_cache[subreddit_name]
         else:
             return False
 
@@ -449,9 +619,7 @@ class ReferenceUrlRewriter(object):
         @return: the rewritten text
         @rtype: L{str}
         """
-        urls = get_urls_from_string(text)
-        for url in urls:
-            new_url = self.rewrite_url(url, to_root=to_root)
-            if new_url != url:
-                text = text.replace(url, new_url)
-        return text
+        if not may_contain_reddit_urls(text):
+            return text
+        # replace all URLs in a single pass
+        return URL.sub(lambda m: self.rewrite_url(m.group(0), to_root=to_root), text)
@@ -1,5 +1,8 @@
 """
 Image and video related utilities.
+
+@var RESIZE_REDUCING_GAP: reducing gap used when resizing images, see L{PIL.Image.Image.resize}
+@type RESIZE_REDUCING_GAP: L{float}
 """
 import argparse
 import math
@@ -16,20 +19,23 @@ Image.MAX_IMAGE_PIXELS *= 10
 # robustness - do not crash with incomplete images
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+# first reduce by an integer factor, then resample the remaining (at least 2x) size
+RESIZE_REDUCING_GAP = 2.0
+
 
 def mimetype_is_image(mimetype):
     """
     Check if a mimetype refers to an image mimetype.
 
     @param mimetype: mimetype to check
-    @type mimetype: L{bool}
+    @type mimetype: L{str} or L{None}
     @return: whether the mimetype is an image mimetype
     @rtype: L{bool}
     """
-    if ";" in mimetype:
-        mimetype = mimetype[:mimetype.find(";")]
-    mimetype = mimetype.strip().lower()
-    return mimetype.startswith("image/")
+    if not mimetype:
+        return False
+    # parameters (e.g. "; charset=...") can not affect the prefix
+    return mimetype.lstrip()[:6].lower() == "image/"
 
 
 def mimetype_is_video(mimetype):
@@ -37,14 +43,33 @@ def mimetype_is_video(mimetype):
     Check if a mimetype refers to a video mimetype.
 
     @param mimetype: mimetype to check
-    @type mimetype: L{bool}
+    @type mimetype: L{str} or L{None}
     @return: whether the mimetype is a video mimetype
     @rtype: L{bool}
     """
-    if ";" in mimetype:
-        mimetype = mimetype[:mimetype.find(";")]
-    mimetype = mimetype.strip().lower()
-    return mimetype.startswith("video/")
+    if not mimetype:
+        return False
+    # parameters (e.g. "; charset=...") can not affect the prefix
+    return mimetype.lstrip()[:6].lower() == "video/"
+
+
+def _resize_frame(img, w, h):
+    """
+    Return a resized copy of an image (frame).
+
+    @param img: image to resize
+    @type img: L{PIL.Image.Image}
+    @param w: new width
+    @type w: L{int}
+    @param h: new height
+    @type h: L{int}
+    @return: the resized image
+    @rtype: L{PIL.Image.Image}
+    """
+    if (img.width, img.height) == (w, h):
+        # only a transcode is required
+        return img.copy()
+    return img.resize((w, h), Image.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
 
 
 def minimize_image(path, max_w=512, max_h=512):
@@ -62,8 +87,6 @@ def minimize_image(path, max_w=512, max_h=512):
     """
     try:
         with Image.open(path) as img:
-            # load image and close the file
-            img.load()
             # find out if it is an animated image (e.g. GIF)
             is_animated = hasattr(img, "is_animated") and img.is_animated
             # resize
@@ -72,13 +95,21 @@ def minimize_image(path, max_w=512, max_h=512):
             ratio = min(w_ratio, h_ratio, 1)
             new_w = math.floor(img.width * ratio)
             new_h = math.floor(img.height * ratio)
+            if (ratio == 1) and (img.format == "WEBP"):
+                # already small enough and in the target format, nothing to do
+                return ("image/webp", os.path.getsize(path))
+            if not is_animated:
+                # let the decoder downscale while decoding (JPEG only)
+                img.draft(img.mode, (new_w, new_h))
+            # load image and close the file
+            img.load()
             if not is_animated:
-                frames = [img.resize((new_w, new_h))]
+                frames = [_resize_frame(img, new_w, new_h)]
             else:
                 frames = []
                 for i in range(getattr(img, "n_frames", 1)):
                     img.seek(i)
-                    frame = img.resize((new_w, new_h))
+                    frame = _resize_frame(img, new_w, new_h)
                     frames.append(frame)
 
     except Image.DecompressionBombError:
@@ -9,27 +9,64 @@ Import logic.
 @type COMMENT_COLUMNS: L{list} of L{str}
 @var COMMENT_FILTERS: a dictionary mapping comment columns to transformer to apply
 @type COMMENT_FILTERS: L{dict} of L{str} -> callable
+@var POST_FILTER_FUNCS: a dictionary mapping each post column to the transformer to apply
+@type POST_FILTER_FUNCS: L{dict} of L{str} -> callable
+@var COMMENT_FILTER_FUNCS: a dictionary mapping each comment column to the transformer to apply
+@type COMMENT_FILTER_FUNCS: L{dict} of L{str} -> callable
+@var IN_QUERY_BATCH_SIZE: maximum number of values in a single IN query
+@type IN_QUERY_BATCH_SIZE: L{int}
+@var NAME_CACHE_SIZE: number of post and comment names kept by each L{NameCache} while importing comments
+@type NAME_CACHE_SIZE: L{int}
+@var POST_IMPORT_KEYS: keys from dataset posts used during the import
+@type POST_IMPORT_KEYS: L{frozenset} of L{str}
+@var COMMENT_IMPORT_KEYS: keys from dataset comments used during the import
+@type COMMENT_IMPORT_KEYS: L{frozenset} of L{str}
 """
-import json
+import io
 import datetime
+import contextlib
+import collections
 
-from sqlalchemy import select
+from sqlalchemy import select, insert, update
 
-from .jsonl import process_jsonl
+from .jsonl import process_jsonl, process_jsonl_parallel, dumps_json
 from .db.models import Post, User, Comment, Subreddit, ARCTICZIM_USERNAME
-from .util import chunked
+from .util import chunked, iter_in_background
+
+
+def _identity(value):
+    """
+    Return the value unchanged.
+
+    This is the default filter for columns without an entry in
+    L{POST_FILTERS} or L{COMMENT_FILTERS}.
+
+    @param value: value to return
+    @type value: any
+    @return: the value
+    @rtype: any
+    """
+    return value
 
 
 POST_COLUMNS = [c.key for c in Post.__table__.columns]
 POST_FILTERS = {
-    "poll_data": json.dumps,
-    "media_metadata": json.dumps,
+    "poll_data": dumps_json,
+    "media_metadata": dumps_json,
     "edited": lambda x: {False: 0, True: -1}.get(x, x),
 }
 COMMENT_COLUMNS = [c.key for c in Comment.__table__.columns]
 COMMENT_FILTERS = {
     "edited": lambda x: {False: 0, True: -1}.get(x, x)
 }
+IN_QUERY_BATCH_SIZE = 500
+NAME_CACHE_SIZE = 200000
+POST_FILTER_FUNCS = {key: POST_FILTERS.get(key, _identity) for key in POST_COLUMNS}
+COMMENT_FILTER_FUNCS = {key: COMMENT_FILTERS.get(key, _identity) for key in COMMENT_COLUMNS}
+# keys required for creating the users and subreddits
+_SHARED_IMPORT_KEYS = ("author", "author_created_utc", "subreddit", "subreddit_subscribers")
+POST_IMPORT_KEYS = frozenset(POST_COLUMNS).union(_SHARED_IMPORT_KEYS, ("media", ))
+COMMENT_IMPORT_KEYS = frozenset(COMMENT_COLUMNS).union(_SHARED_IMPORT_KEYS)
 
 
 def prepare_db(session):
@@ -51,7 +88,7 @@ def prepare_db(session):
         session.commit()
 
 
-def import_posts(session, posts):
+def import_posts(session, posts, commit=True):
     """
     Create a database post from a dataset post and insert it into the db.
 
@@ -60,202 +97,533 @@ def import_posts(session, posts):
 
     @param posts: list of dictionaries from dataset containing post data
     @type posts: L{list} of L{dict}
+    @param commit: if nonzero, commit the session, otherwise only flush it
+    @type commit: L{bool}
     """
-    # get or create authors
-    authors = {}
-    for d in posts:
-        author_name = d["author"]
-        if author_name not in authors:
-            author = session.get(User, author_name)
-            if author is None:
-                author = User(
-                    # id=d["author_fullname"],
-                    name=author_name,
-                    created=datetime.datetime.fromtimestamp(
-                        d["author_created_utc"]
-                        if d.get("author_created_utc", None) is not None
-                        else 0
-                    ),
-                )
-                session.add(author)
-            authors[author_name] = author
-    # get or create subreddit
-    subreddits = {}
-    for d in posts:
-        subreddit_name = d["subreddit"]
-        if subreddit_name not in subreddits:
-            subreddit = session.get(Subreddit, subreddit_name)
-            if subreddit is None:
-                subreddit = Subreddit(
-                    # id=d["author_fullname"],
-                    name=subreddit_name,
-                    subscribers=d.get("subreddit_subscribers", 0),
-                )
-                session.add(subreddit)
-            if d.get("subreddit_subscribers", 0) > subreddit.subscribers:
-                subreddit.subscribers = d.get("subreddit_subscribers", 0)
-            subreddits[subreddit_name] = subreddit
+    # authors and subreddits need to exist before the posts referencing them
+    _create_authors_and_subreddits(session, posts)
     # create posts
-    post_objs = []
+    post_rows = []
+    root_comment_rows = []
     for d in posts:
-        # create kwargs
-        kwargs = {}
-        author_name = d["author"]
-        subreddit_name = d["subreddit"]
-        kwargs["author_name"] = author_name
-        kwargs["author"] = authors[author_name]
-        kwargs["subreddit_name"] = subreddit_name
-        kwargs["subreddit"] = subreddits[subreddit_name]
-        # fill in remaining kwargs
-        for orgkey in d.keys():
-            key = orgkey
+        # create row
+        row = {}
+        row["author_name"] = d["author"]
+        row["subreddit_name"] = d["subreddit"]
+        # fill in remaining values
+        for key, value in d.items():
             if key == "media" and ("media_metadata" not in d):
                 key = "media_metadata"
-            if key in POST_COLUMNS:
-                value = d[orgkey]
-                if key == "edited" and isinstance(value, bool):
-                    if value:
-                        value = -1
-                    else:
-                        value = 0
-                kwargs[key] = POST_FILTERS.get(key, lambda x: x)(value)
-        post = Post(**kwargs)
-        rc = post.create_root_comment()
-        rc.post = post
-        post_objs.append(post)
+            f = POST_FILTER_FUNCS.get(key, None)
+            if f is not None:
+                row[key] = f(value)
+        post_rows.append(row)
         # generate a root comment
-        session.add(post)
-    session.commit()
+        root_comment_rows.append(_get_root_comment_row(row))
+    if post_rows:
+        bulk_insert(session, Post, post_rows)
+        bulk_insert(session, Comment, root_comment_rows)
+    _finish_batch(session, commit)
+
+
+def _create_authors_and_subreddits(session, entries):
+    """
+    Create the missing authors and subreddits of dataset posts or comments.
+
+    The existing authors and subreddits are looked up using IN queries
+    and the missing ones are inserted in bulk. The subscriber count of
+    existing subreddits is raised if the entries report more subscribers.
+
+    @param session: sqlalchemy session to use
+    @type session: L{sqlalchemy.orm.Session}
+    @param entries: list of dictionaries from dataset containing post or comment data
+    @type entries: L{list} of L{dict}
+    """
+    # authors
+    author_created = {}
+    for d in entries:
+        author_name = d["author"]
+        if author_name not in author_created:
+            author_created[author_name] = d.get("author_created_utc", None)
+    existing_authors = _select_existing(session, User.name, author_created.keys())
+    author_rows = [
+        {
+            "name": author_name,
+            "created": datetime.datetime.fromtimestamp(created if created is not None else 0),
+        }
+        for author_name, created in author_created.items()
+        if author_name not in existing_authors
+    ]
+    if author_rows:
+        session.execute(insert(User), author_rows)
+    # subreddits
+    subscribers = {}
+    for d in entries:
+        subreddit_name = d["subreddit"]
+        n_subscribers = d.get("subreddit_subscribers", 0) or 0
+        if n_subscribers > subscribers.get(subreddit_name, -1):
+            subscribers[subreddit_name] = n_subscribers
+    existing_subscribers = {}
+    for batch in chunked(subscribers.keys(), IN_QUERY_BATCH_SIZE):
+        stmt = select(Subreddit.name, Subreddit.subscribers).where(Subreddit.name.in_(batch))
+        existing_subscribers.update(session.execute(stmt).all())
+    new_rows = []
+    update_rows = []
+    for subreddit_name, n_subscribers in subscribers.items():
+        if subreddit_name not in existing_subscribers:
+            new_rows.append({"name": subreddit_name, "subscribers": n_subscribers})
+        elif n_subscribers > existing_subscribers[subreddit_name]:
+            update_rows.append({"name": subreddit_name, "subscribers": n_subscribers})
+    if new_rows:
+        session.execute(insert(Subreddit), new_rows)
+    if update_rows:
+        # bulk UPDATE by primary key
+        session.execute(update(Subreddit), update_rows)
+
+
+def _finish_batch(session, commit):
+    """
+    Finish the import of a batch.
+
+    @param session: sqlalchemy session to use
+    @type session: L{sqlalchemy.orm.Session}
+    @param commit: if nonzero, commit the session, otherwise only flush it
+    @type commit: L{bool}
+    """
+    if commit:
+        session.commit()
+    else:
+        session.flush()
+    # the imported objects are not needed anymore, keep the identity map small
+    session.expunge_all()
+
+
+def bulk_insert(session, model, rows):
+    """
+    Insert rows into the table of a model.
 
+    On PostgreSQL (using psycopg2), the rows are loaded using COPY,
+    which is considerably faster than INSERTs. Otherwise, a bulk INSERT
+    is used. In both cases, the rows are inserted in the transaction of
+    the session.
 
-def import_posts_from_file(session, path, batch_size=1000):
+    @param session: sqlalchemy session to use
+    @type session: L{sqlalchemy.orm.Session}
+    @param model: model whose table the rows should be inserted into
+    @type model: L{arcticzim.db.models.Base} subclass
+    @param rows: values of the rows to insert
+    @type rows: L{list} of L{dict}
+    """
+    connection = session.connection()
+    if (connection.dialect.name == "postgresql") and (connection.dialect.driver == "psycopg2"):
+        _copy_rows(connection, model.__table__, rows)
+    else:
+        session.execute(insert(model), rows)
+
+
+def _copy_rows(connection, table, rows):
+    """
+    Insert rows into a table using COPY FROM STDIN.
+
+    This requires a psycopg2 connection.
+
+    @param connection: sqlalchemy connection to use
+    @type connection: L{sqlalchemy.engine.Connection}
+    @param table: table to insert rows into
+    @type table: L{sqlalchemy.Table}
+    @param rows: values of the rows to insert
+    @type rows: L{list} of L{dict}
+    """
+    keys = set()
+    for row in rows:
+        keys.update(row.keys())
+    # missing values are NULL, just like in a bulk INSERT
+    columns = [c.key for c in table.columns if c.key in keys]
+    preparer = connection.dialect.identifier_preparer
+    statement = "COPY {} ({}) FROM STDIN".format(
+        preparer.format_table(table),
+        ", ".join(preparer.quote(c) for c in columns),
+    )
+    data = io.StringIO()
+    for row in rows:
+        data.write("\t".join(_format_copy_value(row.get(c, None)) for c in columns))
+        data.write("\n")
+    data.seek(0)
+    with contextlib.closing(connection.connection.cursor()) as cursor:
+        cursor.copy_expert(statement, data)
+
+
+def _format_copy_value(value):
+    """
+    Format a value for the text format of COPY.
+
+    @param value: value to format
+    @type value: L{str}, L{int}, L{float}, L{bool} or L{None}
+    @return: the formated value
+    @rtype: L{str}
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, str):
+        return value.replace(
+            "\\", "\\\\",
+        ).replace(
+            "\t", "\\t",
+        ).replace(
+            "\n", "\\n",
+        ).replace(
+            "\r", "\\r",
+        )
+    return str(value)
+
+
+def _get_root_comment_row(post_row):
+    """
+    Generate the row for the placeholder root comment of a post.
+
+    This is the equivalent of L{arcticzim.db.models.Post.create_root_comment}
+    for bulk inserts.
+
+    @param post_row: the values of the post to create the root comment for
+    @type post_row: L{dict}
+    @return: the values of the root comment
+    @rtype: L{dict}
+    """
+    return {
+        "author_name": ARCTICZIM_USERNAME,
+        "body": "",
+        "controversiality": 0,
+        "created_utc": post_row["created_utc"],
+        "edited": 0,
+        "gilded": 0,
+        "id": post_row["id"],
+        "parent_id": None,
+        "link_id": post_row["name"],
+        "name": post_row["name"],
+        "score": post_row["score"],
+        "ups": 0,
+        "permalink": "",
+        "subreddit_name": post_row["subreddit_name"],
+    }
+
+
+def _should_commit(i, commit_every):
+    """
+    Check whether the session should be committed after a batch.
+
+    @param i: number of the batch, starting at 1
+    @type i: L{int}
+    @param commit_every: commit after this many batches, 0 to only commit at the end
+    @type commit_every: L{int}
+    @return: whether the session should be committed
+    @rtype: L{bool}
+    """
+    return (commit_every > 0) and (i % commit_every == 0)
+
+
+def read_jsonl(path, desc, pool=None, keys=None):
+    """
+    Read a jsonl file, parsing it in a pool if one is specified.
+
+    If a pool is specified, parsing starts immediately. In this case,
+    the workers only send the specified keys of each object back, which
+    reduces the amount of data that needs to be transferred.
+
+    @param path: path to file to read
+    @type path: L{str}
+    @param desc: description for the progress bar
+    @type desc: L{str}
+    @param pool: if specified, parse the file using this pool
+    @type pool: L{multiprocessing.pool.Pool} or L{None}
+    @param keys: if specified, the keys of the objects that are needed
+    @type keys: iterable of L{str} or L{None}
+    @return: an iterable yielding the elements of the file in order
+    @rtype: iterable of L{dict}
+    """
+    if pool is None:
+        return process_jsonl(path, desc=desc)
+    return process_jsonl_parallel(path, pool, desc=desc, keys=keys)
+
+
+def import_posts_from_file(session, path, batch_size=1000, pool=None, commit_every=1):
     """
     Import posts from a arcticshift dataset, adding them to the session.
 
+    The file is read and parsed in a background thread while the
+    posts are imported, the session is only used by this thread.
+
     @param session: sqlalchemy session to use
     @type session: L{sqlalchemy.orm.Session}
     @param path: path to file to read
     @type path: L{str}
     @param batch_size: how many posts to import at once
     @type batch_size: L{int}
+    @param pool: if specified, parse the file using this pool
+    @type pool: L{multiprocessing.pool.Pool} or L{None}
+    @param commit_every: commit after this many batches, 0 to only commit at the end
+    @type commit_every: L{int}
+    """
+    import_posts_from_iterable(
+        session,
+        iter_in_background(
+            read_jsonl(path, desc="Importing posts", pool=pool, keys=POST_IMPORT_KEYS),
+            chunk_size=batch_size,
+        ),
+        batch_size=batch_size,
+        commit_every=commit_every,
+    )
+
+
+def import_posts_from_iterable(session, posts, batch_size=1000, commit_every=1):
+    """
+    Import posts from an iterable of dataset posts, adding them to the session.
+
+    @param session: sqlalchemy session to use
+    @type session: L{sqlalchemy.orm.Session}
+    @param posts: iterable yielding dictionaries from dataset containing post data
+    @type posts: iterable of L{dict}
+    @param batch_size: how many posts to import at once
+    @type batch_size: L{int}
+    @param commit_every: commit after this many batches, 0 to only commit at the end
+    @type commit_every: L{int}
     """
     n = 0
-    for post_batch in chunked(process_jsonl(path, desc="Importing posts"), batch_size):
-        import_posts(session, post_batch)
+    for i, post_batch in enumerate(chunked(posts, batch_size), start=1):
+        import_posts(session, post_batch, commit=_should_commit(i, commit_every))
         n += len(post_batch)
+    session.commit()
     print("Imported {} posts.".format(n))
 
 
-def import_comments(session, comments):
+class NameCache(object):
+    """
+    A bounded set of names (e.g. of comments) known to exist in the database.
+
+    When full, the least recently used names are forgotten.
+    """
+    def __init__(self, maxsize=NAME_CACHE_SIZE):
+        """
+        The default constructor.
+
+        @param maxsize: maximum number of names to keep
+        @type maxsize: L{int}
+        """
+        self.maxsize = maxsize
+        self._names = collections.OrderedDict()
+
+    def __contains__(self, name):
+        """
+        Check if a name is known, marking it as recently used.
+
+        @param name: name to check
+        @type name: L{str}
+        @return: whether the name is known
+        @rtype: L{bool}
+        """
+        if name in self._names:
+            self._names.move_to_end(name)
+            return True
+        return False
+
+    def add(self, name):
+        """
+        Remember a name.
+
+        @param name: name to add
+        @type name: L{str}
+        """
+        self._names[name] = None
+        self._names.move_to_end(name)
+        if len(self._names) > self.maxsize:
+            self._names.popitem(last=False)
+
+    def update(self, names):
+        """
+        Remember multiple names.
+
+        @param names: names to add
+        @type names: iterable of L{str}
+        """
+        for name in names:
+            self.add(name)
+
+
+def import_comments(session, comments, commit=True, posts_cache=None, parents_cache=None):
     """
     Create database comments from dataset comments and insert them into the db.
 
+    To avoid looking up the same posts and parents again for every
+    batch, caches may be passed, which are then updated with the names
+    found and inserted.
+
     @param session: sqlalchemy session to use
     @type session: L{sqlalchemy.orm.Session}
     @param comments: list of dictionaries from dataset containing comment data
     @type comments: L{list} of L{dict}
+    @param commit: if nonzero, commit the session, otherwise only flush it
+    @type commit: L{bool}
+    @param posts_cache: if specified, names of posts known to exist
+    @type posts_cache: L{NameCache} or L{None}
+    @param parents_cache: if specified, names of comments known to exist
+    @type parents_cache: L{NameCache} or L{None}
     @return: the amount of failed imports
     @rtype: L{int}
     """
+    if posts_cache is None:
+        posts_cache = NameCache()
+    if parents_cache is None:
+        parents_cache = NameCache()
     n_fails = 0
-    # get or create authors
-    authors = {}
-    for d in comments:
-        author_name = d["author"]
-        if author_name not in authors:
-            author = session.get(User, author_name)
-            if author is None:
-                author = User(
-                    # id=d["author_fullname"],
-                    name=author_name,
-                    created=datetime.datetime.fromtimestamp(
-                        d["author_created_utc"]
-                        if d.get("author_created_utc", None) is not None
-                        else 0
-                    ),
-                )
-                session.add(author)
-            authors[author_name] = author
-    # get or create subreddits
-    subreddits = {}
-    for d in comments:
-        subreddit_name = d["subreddit"]
-        if subreddit_name not in subreddits:
-            subreddit = session.get(Subreddit, subreddit_name)
-            if subreddit is None:
-                subreddit = Subreddit(
-                    # id=d["author_fullname"],
-                    name=subreddit_name,
-                    subscribers=d.get("subreddit_subscribers", 0),
-                )
-                session.add(subreddit)
-            if d.get("subreddit_subscribers", 0) > subreddit.subscribers:
-                subreddit.subscribers = d.get("subreddit_subscribers", 0)
-            subreddits[subreddit_name] = subreddit
+    # authors and subreddits need to exist before the comments referencing them
+    _create_authors_and_subreddits(session, comments)
     # get posts
-    posts = {}
-    for d in comments:
-        post_name = d["link_id"]
-        if post_name not in posts:
-            post = session.execute(select(Post).where(Post.name == post_name)).one_or_none()
-            if post is not None:
-                posts[post_name] = post[0]
+    existing_posts = {d["link_id"] for d in comments if d["link_id"] in posts_cache}
+    new_posts = _select_existing(session, Post.name, {d["link_id"] for d in comments}.difference(existing_posts))
+    posts_cache.update(new_posts)
+    existing_posts.update(new_posts)
+    # get the parents not in this batch
+    names = {d["name"] for d in comments}
+    parent_ids = {d["parent_id"] for d in comments if d["parent_id"] not in names}
+    parents = {parent_id for parent_id in parent_ids if parent_id in parents_cache}
+    parents.update(_select_existing(session, Comment.name, parent_ids.difference(parents)))
     # create comments:
-    parents = {}
-    for d in comments:
-        kwargs = {}
-        author_name = d["author"]
-        author = authors[author_name]
-        kwargs["author"] = author
-        kwargs["author_name"] = author_name
-        subreddit_name = d["subreddit"]
-        subreddit = subreddits[subreddit_name]
-        kwargs["subreddit"] = subreddit
-        kwargs["subreddit_name"] = subreddit_name
-        post = posts.get(d["link_id"])
-        if post is None:
+    comment_rows = []
+    for d in _sort_parents_first(comments, names):
+        row = {}
+        row["author_name"] = d["author"]
+        row["subreddit_name"] = d["subreddit"]
+        if d["link_id"] not in existing_posts:
             n_fails += 1
             continue
-        kwargs["post"] = post
-        parent_id = d["parent_id"]
-        if parent_id not in parents:
-            parent = session.execute(select(Comment).where(Comment.name == parent_id)).one_or_none()
-            if parent is None:
-                # can't insert comment before parent
-                n_fails += 1
-                continue
-            parent = parent[0]
-            parents[parent_id] = parent
-        else:
-            parent = parents[parent_id]
-        kwargs["parent"] = parent
-        # fill in remaining kwargs
-        for key in d.keys():
-            if key in COMMENT_COLUMNS:
-                value = d[key]
-                kwargs[key] = COMMENT_FILTERS.get(key, lambda x: x)(value)
-        comment = Comment(**kwargs)
-        session.add(comment)
-        parents[comment.name] = comment
-    session.commit()
+        if d["parent_id"] not in parents:
+            # can't insert comment before parent
+            n_fails += 1
+            continue
+        # fill in remaining values
+        for key, value in d.items():
+            f = COMMENT_FILTER_FUNCS.get(key, None)
+            if f is not None:
+                row[key] = f(value)
+        comment_rows.append(row)
+        parents.add(row["name"])
+    if comment_rows:
+        bulk_insert(session, Comment, comment_rows)
+    _finish_batch(session, commit)
+    # the inserted comments may be the parents of comments in later batches
+    parents_cache.update(row["name"] for row in comment_rows)
     return n_fails
 
 
-def import_comments_from_file(session, path, batch_size=1000):
+def _select_existing(session, column, values):
+    """
+    Return those of the values which exist in a column.
+
+    The values are checked using IN queries of up to
+    L{IN_QUERY_BATCH_SIZE} values each.
+
+    @param session: sqlalchemy session to use
+    @type session: L{sqlalchemy.orm.Session}
+    @param column: column to search in
+    @type column: L{sqlalchemy.orm.InstrumentedAttribute}
+    @param values: values to search for
+    @type values: L{set}
+    @return: the values found in the column
+    @rtype: L{set}
+    """
+    found = set()
+    for batch in chunked(values, IN_QUERY_BATCH_SIZE):
+        found.update(session.execute(select(column).where(column.in_(batch))).scalars())
+    return found
+
+
+def _sort_parents_first(comments, names):
+    """
+    Order comments so that each comment comes after its parent.
+
+    Only parents within the comments are considered. Otherwise, the
+    order of the comments is kept.
+
+    @param comments: comments to sort
+    @type comments: L{list} of L{dict}
+    @param names: names of the comments
+    @type names: L{set} of L{str}
+    @return: the sorted comments
+    @rtype: L{list} of L{dict}
+    """
+    children = {}
+    ordered = []
+    for d in comments:
+        if d["parent_id"] in names:
+            children.setdefault(d["parent_id"], []).append(d)
+        else:
+            ordered.append(d)
+    # breadth-first, appending the children of each comment once it is ordered
+    i = 0
+    while i < len(ordered):
+        ordered.extend(children.pop(ordered[i]["name"], ()))
+        i += 1
+    # comments whose parents could not be ordered (e.g. duplicate names)
+    for remaining in children.values():
+        ordered.extend(remaining)
+    return ordered
+
+
+def import_comments_from_file(session, path, batch_size=1000, pool=None, commit_every=1):
     """
     Import comments from a arcticshift dataset, adding them to the session.
 
+    The file is read and parsed in a background thread while the
+    comments are imported, the session is only used by this thread.
+
     @param session: sqlalchemy session to use
     @type session: L{sqlalchemy.orm.Session}
     @param path: path to file to read
     @type path: L{str}
     @param batch_size: how many comments to import at once
     @type batch_size: L{int}
+    @param pool: if specified, parse the file using this pool
+    @type pool: L{multiprocessing.pool.Pool} or L{None}
+    @param commit_every: commit after this many batches, 0 to only commit at the end
+    @type commit_every: L{int}
+    """
+    import_comments_from_iterable(
+        session,
+        iter_in_background(
+            read_jsonl(path, desc="Importing comments", pool=pool, keys=COMMENT_IMPORT_KEYS),
+            chunk_size=batch_size,
+        ),
+        batch_size=batch_size,
+        commit_every=commit_every,
+    )
+
+
+def import_comments_from_iterable(session, comments, batch_size=1000, commit_every=1):
+    """
+    Import comments from an iterable of dataset comments, adding them to the session.
+
+    @param session: sqlalchemy session to use
+    @type session: L{sqlalchemy.orm.Session}
+    @param comments: iterable yielding dictionaries from dataset containing comment data
+    @type comments: iterable of L{dict}
+    @param batch_size: how many comments to import at once
+    @type batch_size: L{int}
+    @param commit_every: commit after this many batches, 0 to only commit at the end
+    @type commit_every: L{int}
     """
     n = 0
     n_fails = 0
-    for comment_batch in chunked(process_jsonl(path, desc="Importing comments"), batch_size):
-        cur_fails = import_comments(session, comment_batch)
+    # the caches are kept across batches
+    posts_cache = NameCache()
+    parents_cache = NameCache()
+    for i, comment_batch in enumerate(chunked(comments, batch_size), start=1):
+        cur_fails = import_comments(
+            session,
+            comment_batch,
+            commit=_should_commit(i, commit_every),
+            posts_cache=posts_cache,
+            parents_cache=parents_cache,
+        )
         n += len(comment_batch) - cur_fails
         n_fails += cur_fails
+    session.commit()
     print("Imported {} comments, failed to import {} comments..".format(n, n_fails))
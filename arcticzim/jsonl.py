@@ -1,5 +1,12 @@
 """
 Utilities for working with jsonl files.
+
+@var PARSE_CHUNK_SIZE: approximate size of the file chunks parsed by each worker, in bytes
+@type PARSE_CHUNK_SIZE: L{int}
+@var READ_BUFFER_SIZE: size of the read buffer for jsonl files, in bytes
+@type READ_BUFFER_SIZE: L{int}
+@var READ_BLOCK_SIZE: size of the blocks jsonl files are split into lines in, in bytes
+@type READ_BLOCK_SIZE: L{int}
 """
 import argparse
 import os
@@ -7,9 +14,66 @@ import json
 import pprint
 import math
 import datetime
+import collections
 
 from tqdm.auto import tqdm
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+PARSE_CHUNK_SIZE = 8 * 1024 * 1024
+READ_BUFFER_SIZE = 1024 * 1024
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+
+# exact types of parsed json values, see analyze_jsonl()
+_SIZED_TYPES = frozenset((str, list, tuple))
+# bool is a subclass of int and thus included
+_NUMERIC_TYPES = frozenset((int, float, bool))
+
+
+def loads_json(data):
+    """
+    Parse a json document.
+
+    If available, orjson is used to parse the document.
+
+    @param data: the json document to parse
+    @type data: L{bytes} or L{str}
+    @return: the parsed element
+    @rtype: a json element, usually a L{dict}
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson is stricter than json (e.g. regarding NaN), retry below
+            pass
+    return json.loads(data)
+
+
+def dumps_json(obj):
+    """
+    Serialize an object to a json document.
+
+    If available, orjson is used to serialize the object. The resulting
+    document is compact, but can still be read by L{loads_json}.
+
+    @param obj: object to serialize
+    @type obj: a json element, usually a L{dict}
+    @return: the json document
+    @rtype: L{str}
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode("utf-8")
+        except (orjson.JSONEncodeError, TypeError):
+            # e.g. integers larger than 64 bit, retry below
+            pass
+    return json.dumps(obj)
+
 
 def write_jsonl(path, iterable):
     """
@@ -22,7 +86,28 @@ def write_jsonl(path, iterable):
     """
     with open(path, "w") as fout:
         for entry in iterable:
-            fout.write(json.dumps(entry) + "\n")
+            fout.write(dumps_json(entry) + "\n")
+
+
+def advise_sequential(f, offset=0, length=0):
+    """
+    Tell the OS that a file will be read sequentially.
+
+    This increases the readahead of the file. On platforms not
+    supporting this, nothing happens.
+
+    @param f: file that will be read
+    @type f: file-like object
+    @param offset: offset of the region that will be read
+    @type offset: L{int}
+    @param length: length of the region that will be read, 0 for until the end
+    @type length: L{int}
+    """
+    try:
+        os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_SEQUENTIAL)
+    except (AttributeError, OSError):
+        # not supported by OS or file
+        pass
 
 
 def process_jsonl(path, desc="Reading file"):
@@ -36,20 +121,184 @@ def process_jsonl(path, desc="Reading file"):
     @yields: each element in the jsonl file
     @ytype: a json element, usually a L{dict}
     """
-    with open(path, "r") as fin:
+    with open(path, "rb", buffering=READ_BUFFER_SIZE) as fin:
+        advise_sequential(fin)
         total_size = fin.seek(0, os.SEEK_END)
         fin.seek(0, os.SEEK_SET)
         entry = 0
+        # incomplete last line of the previous block
+        remainder = b""
 
         with tqdm(desc=desc, total=total_size, unit="B", unit_scale=True, unit_divisor=1024) as t:
 
-            for line in fin:
+            while True:
+                block = fin.read(READ_BLOCK_SIZE)
+                if not block:
+                    break
+                lines = block.split(b"\n")
+                lines[0] = remainder + lines[0]
+                remainder = lines.pop()
+                for line in lines:
+                    entry += 1
+                    # surrounding whitespace is accepted by the parser
+                    if line and not line.isspace():
+                        yield loads_json(line)
+                t.set_postfix(entry=entry, refresh=False)
+                t.update(len(block))
+            sline = remainder.strip()
+            if sline:
                 entry += 1
                 t.set_postfix(entry=entry, refresh=False)
-                t.update(len(line))
-                sline = line.strip()
-                if sline:
-                    yield json.loads(sline)
+                yield loads_json(sline)
+
+
+def get_jsonl_chunks(path, chunk_size=PARSE_CHUNK_SIZE):
+    """
+    Split a jsonl file into chunks ending at line boundaries.
+
+    @param path: path to the file to split
+    @type path: L{str}
+    @param chunk_size: approximate size of each chunk in bytes
+    @type chunk_size: L{int}
+    @return: a list of (path, start, end) tuples describing the chunks
+    @rtype: L{list} of L{tuple} of (L{str}, L{int}, L{int})
+    """
+    chunks = []
+    with open(path, "rb") as fin:
+        total_size = fin.seek(0, os.SEEK_END)
+        start = 0
+        while start < total_size:
+            fin.seek(min(start + chunk_size, total_size), os.SEEK_SET)
+            fin.readline()
+            end = min(fin.tell(), total_size)
+            chunks.append((path, start, end))
+            start = end
+    return chunks
+
+
+def parse_jsonl_chunk(chunk, keys=None):
+    """
+    Parse a chunk of a jsonl file.
+
+    This is a top-level function so that it can be used by worker processes.
+
+    @param chunk: a (path, start, end) tuple as returned by L{get_jsonl_chunks}
+    @type chunk: L{tuple} of (L{str}, L{int}, L{int})
+    @param keys: if specified, remove all other keys from the parsed objects
+    @type keys: L{frozenset} of L{str} or L{None}
+    @return: the elements in this chunk
+    @rtype: L{list} of json elements, usually L{dict}
+    """
+    path, start, end = chunk
+    with open(path, "rb") as fin:
+        advise_sequential(fin, start, end - start)
+        fin.seek(start, os.SEEK_SET)
+        data = fin.read(end - start)
+    elements = []
+    for line in data.splitlines():
+        if line and not line.isspace():
+            element = loads_json(line)
+            if (keys is not None) and isinstance(element, dict):
+                element = {k: v for k, v in element.items() if k in keys}
+            elements.append(element)
+    return elements
+
+
+def process_jsonl_parallel(path, pool, desc="Reading file", chunk_size=PARSE_CHUNK_SIZE, max_pending=None, keys=None):
+    """
+    Process a jsonl file using a pool of worker processes, yielding each element.
+
+    The file is split into chunks, which are parsed by the workers. The
+    elements are yielded in the same order as they appear in the file.
+    Only a limited number of chunks is parsed ahead, limiting memory usage.
+
+    Unlike L{process_jsonl}, this is not a generator function. The first
+    chunks are submitted to the pool immediately, so a file can already
+    be parsed while another one is still being processed.
+
+    @param path: path to the file to read
+    @type path: L{str}
+    @param pool: pool to parse the chunks in
+    @type pool: L{multiprocessing.pool.Pool}
+    @param desc: description for the tqdm progressbar
+    @type desc: L{str}
+    @param chunk_size: approximate size of each chunk in bytes
+    @type chunk_size: L{int}
+    @param max_pending: max number of chunks to parse ahead, defaults to twice the CPU count
+    @type max_pending: L{int} or L{None}
+    @param keys: if specified, the workers remove all other keys from the objects before sending them back
+    @type keys: iterable of L{str} or L{None}
+    @return: an iterator yielding each element in the jsonl file
+    @rtype: iterator of json elements, usually L{dict}
+    """
+    chunks = get_jsonl_chunks(path, chunk_size=chunk_size)
+    total_size = (chunks[-1][2] if chunks else 0)
+    if max_pending is None:
+        max_pending = 2 * (os.cpu_count() or 1)
+    if keys is not None:
+        keys = frozenset(keys)
+    pending = collections.deque()
+    chunk_iter = iter(chunks)
+    _submit_jsonl_chunks(pool, chunk_iter, pending, max_pending, keys)
+    return _iter_parsed_chunks(pool, chunk_iter, pending, max_pending, total_size, desc, keys)
+
+
+def _submit_jsonl_chunks(pool, chunk_iter, pending, max_pending, keys=None):
+    """
+    Submit chunks to the pool until enough chunks are pending.
+
+    @param pool: pool to parse the chunks in
+    @type pool: L{multiprocessing.pool.Pool}
+    @param chunk_iter: iterator yielding the remaining chunks
+    @type chunk_iter: iterator of L{tuple}
+    @param pending: the pending chunks and their async results, will be modified
+    @type pending: L{collections.deque}
+    @param max_pending: max number of pending chunks
+    @type max_pending: L{int}
+    @param keys: if specified, keys to keep in the parsed objects
+    @type keys: L{frozenset} of L{str} or L{None}
+    """
+    while len(pending) < max_pending:
+        chunk = next(chunk_iter, None)
+        if chunk is None:
+            break
+        pending.append((chunk, pool.apply_async(parse_jsonl_chunk, (chunk, keys))))
+
+
+def _iter_parsed_chunks(pool, chunk_iter, pending, max_pending, total_size, desc, keys=None):
+    """
+    Yield the elements of the parsed chunks in order, submitting new chunks as needed.
+
+    This is a helper function for L{process_jsonl_parallel}.
+
+    @param pool: pool to parse the chunks in
+    @type pool: L{multiprocessing.pool.Pool}
+    @param chunk_iter: iterator yielding the remaining chunks
+    @type chunk_iter: iterator of L{tuple}
+    @param pending: the pending chunks and their async results
+    @type pending: L{collections.deque}
+    @param max_pending: max number of pending chunks
+    @type max_pending: L{int}
+    @param total_size: total size of the file
+    @type total_size: L{int}
+    @param desc: description for the tqdm progressbar
+    @type desc: L{str}
+    @param keys: if specified, keys to keep in the parsed objects
+    @type keys: L{frozenset} of L{str} or L{None}
+    @yields: each element in the jsonl file
+    @ytype: a json element, usually a L{dict}
+    """
+    entry = 0
+    with tqdm(desc=desc, total=total_size, unit="B", unit_scale=True, unit_divisor=1024) as t:
+        while pending:
+            chunk, result = pending.popleft()
+            _submit_jsonl_chunks(pool, chunk_iter, pending, max_pending, keys)
+            elements = result.get()
+            for element in elements:
+                entry += 1
+                yield element
+            t.set_postfix(entry=entry, refresh=False)
+            t.update(chunk[2] - chunk[1])
 
 
 def analyze_jsonl(path):
@@ -65,37 +314,50 @@ def analyze_jsonl(path):
     first = True
     for element in process_jsonl(path=path, desc="Analyzing file"):
         keys = element.keys()
-        for key in keys:
-            value = element[key]
-            if key not in fields:
-                fields[key] = {
+        for key, value in element.items():
+            field = fields.get(key, None)
+            if field is None:
+                # the stats are seeded so that they can always be compared
+                field = fields[key] = {
                     "always_present": first,
                     "types": set(),
                     "nullable": False,
                     "example": value,
                     "count": 0,
+                    "max_length": -1,
+                    "min_value": math.inf,
+                    "max_value": -math.inf,
                 }
-            fields[key]["types"].add(type(value))
-            fields[key]["count"] += 1
-            if value and not fields[key]["example"]:
-                fields[key]["example"] = value
+            value_type = type(value)
+            field["types"].add(value_type)
+            field["count"] += 1
+            if value and not field["example"]:
+                field["example"] = value
             if value is None:
-                fields[key]["nullable"] = True
-            if isinstance(value, (str, list, tuple)):
+                field["nullable"] = True
+            elif value_type in _SIZED_TYPES:
                 length = len(value)
-                if ("max_length" not in fields[key]) or (fields[key]["max_length"] < length):
-                    fields[key]["max_length"] = length
-            if isinstance(value, (int, float)):
-                if ("min_value" not in fields[key]) or (fields[key]["min_value"] > value):
-                    fields[key]["min_value"] = value
-                if ("max_value" not in fields[key]) or (fields[key]["max_value"] < value):
-                    fields[key]["max_value"] = value
-
-            for existing_key in fields:
-                if existing_key not in keys:
-                    fields[existing_key]["always_present"] = False
+                if field["max_length"] < length:
+                    field["max_length"] = length
+            elif value_type in _NUMERIC_TYPES:
+                if field["min_value"] > value:
+                    field["min_value"] = value
+                if field["max_value"] < value:
+                    field["max_value"] = value
+
+        if len(keys) < len(fields):
+            # some fields are missing in this element
+            for existing_key in fields.keys() - keys:
+                fields[existing_key]["always_present"] = False
         first = False
 
+    # remove the stats which do not apply to a field
+    for field in fields.values():
+        if field["max_length"] < 0:
+            del field["max_length"]
+        if field["min_value"] > field["max_value"]:
+            del field["min_value"]
+            del field["max_value"]
     return fields
 
 
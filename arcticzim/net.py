@@ -0,0 +1,125 @@
+"""
+This module contains the shared HTTP functionality.
+
+@var HTTP_POOL_SIZE: number of hosts and connections per host kept by each HTTP session
+@type HTTP_POOL_SIZE: L{int}
+@var HTTP_RETRIES: how often a failed HTTP request is retried
+@type HTTP_RETRIES: L{int}
+@var HTTP_TIMEOUT: connect and read timeout for HTTP requests, in seconds
+@type HTTP_TIMEOUT: L{tuple} of (L{int}, L{int})
+@var API_TIMEOUT: connect and read timeout for requests to the arctic shift API, in seconds
+@type API_TIMEOUT: L{tuple} of (L{int}, L{int})
+"""
+import threading
+import datetime
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+HTTP_POOL_SIZE = 32
+HTTP_RETRIES = 3
+HTTP_TIMEOUT = (5, 30)
+# searches may take a while to be answered
+API_TIMEOUT = (5, 120)
+
+_UTC = datetime.timezone.utc
+
+# HTTP sessions of the threads, see get_http_session()
+_http_sessions = threading.local()
+
+
+def get_http_session():
+    """
+    Return the HTTP session of this thread, creating it if necessary.
+
+    Using a single session allows connections to the same host to be
+    kept alive and reused between requests. Requests failing due to
+    temporary errors are retried.
+
+    @return: the HTTP session
+    @rtype: L{requests.Session}
+    """
+    http_session = getattr(_http_sessions, "session", None)
+    if http_session is None:
+        http_session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_SIZE,
+            pool_maxsize=HTTP_POOL_SIZE,
+            max_retries=Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=1,
+                status_forcelist=(429, 500, 502, 503, 504),
+            ),
+        )
+        http_session.mount("http://", adapter)
+        http_session.mount("https://", adapter)
+        _http_sessions.session = http_session
+    return http_session
+
+
+def format_api_timestamp(timestamp):
+    """
+    Format a unix timestamp for use in arctic shift API queries.
+
+    The timestamp is formatted as UTC, independent of the local timezone.
+
+    @param timestamp: unix timestamp to format
+    @type timestamp: L{int} or L{float}
+    @return: the formatted timestamp
+    @rtype: L{str}
+    """
+    return datetime.datetime.fromtimestamp(timestamp, _UTC).replace(tzinfo=None).isoformat()
+
+
+def get_url_host(url):
+    """
+    Return the scheme and host of an URL, used to group URLs by host.
+
+    @param url: url to get host of
+    @type url: L{str}
+    @return: a tuple of (scheme, host)
+    @rtype: L{tuple} of (L{str}, L{str})
+    """
+    parts = urlparse(url)
+    return (parts.scheme, parts.netloc)
+
+
+class HostRateLimiter(object):
+    """
+    A thread-safe rate limiter, limiting the frequency of requests to each host.
+
+    @ivar interval: min time between two requests to the same host in seconds
+    @type interval: L{int} or L{float}
+    """
+    def __init__(self, interval):
+        """
+        The default constructor.
+
+        @param interval: min time between two requests to the same host in seconds
+        @type interval: L{int} or L{float}
+        """
+        self.interval = interval
+        self._lock = threading.Lock()
+        # host -> earliest time of the next request
+        self._next_request = {}
+
+    def wait(self, url):
+        """
+        Wait until a request to the host of the specified URL may be made.
+
+        @param url: url that will be requested
+        @type url: L{str}
+        """
+        if not self.interval:
+            return
+        host = get_url_host(url)
+        with self._lock:
+            now = time.monotonic()
+            request_time = max(now, self._next_request.get(host, now))
+            self._next_request[host] = request_time + self.interval
+        if request_time > now:
+            time.sleep(request_time - now)
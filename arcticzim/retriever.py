@@ -4,9 +4,11 @@ This module contains functionality for automatically downloading post and commen
 import datetime
 import time
 
-import requests
 import tqdm
 
+from .net import get_http_session, format_api_timestamp, API_TIMEOUT
+from .jsonl import loads_json
+
 
 def retrieve_posts(subreddit=None, author=None, after=None, before=None, sleep=0.1):
     """
@@ -42,27 +44,29 @@ def retrieve_posts(subreddit=None, author=None, after=None, before=None, sleep=0
     if after is None:
         after = 0
     if before is not None:
-        params["before"] = datetime.datetime.fromtimestamp(before).isoformat()
+        params["before"] = format_api_timestamp(before)
 
     # retrieve posts
     bar = tqdm.tqdm(desc="Retrieving posts", unit="posts")
     n_requests = 0
     n_posts = 0
     while True:
-        params["after"] = datetime.datetime.fromtimestamp(after).isoformat()
+        params["after"] = format_api_timestamp(after)
         n_requests += 1
-        r = requests.get(
+        r = get_http_session().get(
             "https://arctic-shift.photon-reddit.com/api/posts/search",
             params=params,
+            timeout=API_TIMEOUT,
         )
         r.raise_for_status()
-        content = r.json()["data"]
+        content = loads_json(r.content)["data"]
         if not content:
             # end of data reached
             break
         for post in content:
             yield post
-            bar.update(1)
+        # update the progress bar once per page
+        bar.update(len(content))
         after = post["created_utc"] + 1
         bar.set_postfix({"Time": datetime.datetime.fromtimestamp(after).isoformat(), "requests": n_requests})
         time.sleep(sleep)
@@ -102,27 +106,29 @@ def retrieve_comments(subreddit=None, author=None, after=None, before=None, slee
     if after is None:
         after = 0
     if before is not None:
-        params["before"] = datetime.datetime.fromtimestamp(before).isoformat()
+        params["before"] = format_api_timestamp(before)
 
     # retrieve comments
     bar = tqdm.tqdm(desc="Retrieving comments", unit="comments")
     n_requests = 0
     n_comments = 0
     while True:
-        params["after"] = datetime.datetime.fromtimestamp(after).isoformat()
+        params["after"] = format_api_timestamp(after)
         n_requests += 1
-        r = requests.get(
+        r = get_http_session().get(
             "https://arctic-shift.photon-reddit.com/api/comments/search",
             params=params,
+            timeout=API_TIMEOUT,
         )
         r.raise_for_status()
-        content = r.json()["data"]
+        content = loads_json(r.content)["data"]
         if not content:
             # end of data reached
             break
         for comment in content:
             yield comment
-            bar.update(1)
+        # update the progress bar once per page
+        bar.update(len(content))
         after = comment["created_utc"] + 1
         bar.set_postfix({"Time": datetime.datetime.fromtimestamp(after).isoformat(), "requests": n_requests})
         time.sleep(sleep)
@@ -3,22 +3,51 @@ Various utility functions.
 
 @var ALLOWED_WORD_LETTERS: a regular expression pattern used to to identify where words end.
 @type ALLOWED_WORD_LETERS: L{re.Pattern}
+@var WORD: a regular expression pattern matching a single word, the inverse of L{ALLOWED_WORD_LETTERS}
+@type WORD: L{re.Pattern}
 @var ALLOWED_REDDIT_NAME_LETTERS: a regular expression pattern used to normalize reddit names
 @type ALLOWED_REDDIT_NAME_LETTERS: L{re.Pattern}
-@var URL: a regular expression matching likely URLs
-@type URL: L{re.Pattern}
+@var URL: a regular expression matching likely URLs, compiled with re2 if available
+@type URL: L{re.Pattern} or L{re2._Regexp}
+@var REDDIT_HOST: a regular expression matching the hosts accepted by L{parse_reddit_url}
+@type REDDIT_HOST: L{re.Pattern}
+@var BACKGROUND_QUEUE_SIZE: number of chunks L{iter_in_background} may produce ahead
+@type BACKGROUND_QUEUE_SIZE: L{int}
 """
 import datetime
 import re
 import os
 import decimal
+import bisect
+import queue
+import threading
+import itertools
 from urllib.parse import urlparse
 
+try:
+    import re2
+except ImportError:
+    re2 = None
+
 
 ALLOWED_WORD_LETTERS = re.compile(r"[^\w|\-]")
+WORD = re.compile(r"[\w|\-]+")
 ALLOWED_REDDIT_NAME_LETTERS = re.compile(r"[^A-Za-z0-9_\-]")
 # from https://stackoverflow.com/a/3809435 (modified)
-URL = re.compile(r"https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*[-a-zA-Z0-9@:%_\+.~#?&//=])")
+# this pattern only uses ASCII classes, so re2 matches the same URLs in linear time
+URL = (re2 if re2 is not None else re).compile(r"https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*[-a-zA-Z0-9@:%_\+.~#?&//=])")
+REDDIT_HOST = re.compile(r"reddit\.com|redd\.it", re.IGNORECASE)
+
+# units used by format_number() and format_size() and the values at which they start
+_NUMBER_UNITS = ("", "K", "M", "B", "T", "Qa", "Qi")
+_NUMBER_DIVISORS = tuple(1000.0 ** i for i in range(len(_NUMBER_UNITS)))
+_SIZE_UNITS = ("B", "KiB", "MiB", "GiB", "TiB", "PiB", "EiB")
+_SIZE_DIVISORS = tuple(1024.0 ** i for i in range(len(_SIZE_UNITS)))
+BACKGROUND_QUEUE_SIZE = 4
+
+# the package and resource directories do not change, compute them once
+_PACKAGE_DIR = os.path.dirname(__file__)
+_RESOURCE_DIR = os.path.join(_PACKAGE_DIR, "resources")
 
 
 def format_timedelta(seconds):
@@ -57,12 +86,11 @@ def format_number(n, allow_none=False):
             raise TypeError("format_number() got called with 'None' and allow_none=False!")
     if n < 1000 and isinstance(n, int):
         return str(n)
-    for fmt in ("", "K", "M", "B", "T", "Qa"):
-        if n < 1000.0:
-            return "{:.2f}{}".format(round(n, 3), fmt)
-        else:
-            n /= 1000.0
-    return "{:.2f}Qi".format(round(n, 2))
+    # find the unit directly instead of dividing repeatedly
+    n = float(n)
+    i = bisect.bisect_right(_NUMBER_DIVISORS, n, 1) - 1
+    n /= _NUMBER_DIVISORS[i]
+    return "{:.2f}{}".format(round(n, (2 if i == len(_NUMBER_UNITS) - 1 else 3)), _NUMBER_UNITS[i])
 
 
 def format_size(nbytes):
@@ -74,12 +102,10 @@ def format_size(nbytes):
     @return: a human readable string describing the size
     @rtype: L{str}
     """
-    for fmt in ("B", "KiB", "MiB", "GiB", "TiB", "PiB"):
-        if nbytes < 1024.0:
-            return "{:.2f} {}".format(round(nbytes, 2), fmt)
-        else:
-            nbytes /= 1024.0
-    return "{:.2f} EiB".format(round(nbytes, 2))
+    # find the unit directly instead of dividing repeatedly
+    nbytes = float(nbytes)
+    i = bisect.bisect_right(_SIZE_DIVISORS, nbytes, 1) - 1
+    return "{:.2f} {}".format(round(nbytes / _SIZE_DIVISORS[i], 2), _SIZE_UNITS[i])
 
 
 def format_date(date):
@@ -101,7 +127,7 @@ def get_package_dir():
     @return: the path to the root directory of this package (not repo!)
     @rtype: L{str}
     """
-    return os.path.dirname(__file__)
+    return _PACKAGE_DIR
 
 
 def get_resource_file_path(*names):
@@ -113,7 +139,7 @@ def get_resource_file_path(*names):
     @return: path to the resource file
     @rtype: L{str}
     """
-    p = os.path.join(get_package_dir(), "resources", *names)
+    p = os.path.join(_RESOURCE_DIR, *names)
     return p
 
 
@@ -130,10 +156,7 @@ def add_to_dict_list(d, k, v):
     @param v: value to append
     @type v: any
     """
-    if k in d:
-        d[k].append(v)
-    else:
-        d[k] = [v]
+    d.setdefault(k, []).append(v)
 
 
 def count_words(text):
@@ -145,7 +168,8 @@ def count_words(text):
     @return: number of words in text.
     @rtype: L{int}
     """
-    return len(ALLOWED_WORD_LETTERS.sub(" ", text).split())
+    # count the matches without creating a modified copy of the text
+    return sum(1 for _ in WORD.finditer(text))
 
 
 def set_or_increment(d, k, v=1):
@@ -161,10 +185,7 @@ def set_or_increment(d, k, v=1):
     @type v: value to set to or increment by
     @type v: L{int} or L{float}
     """
-    if k in d:
-        d[k] += v
-    else:
-        d[k] = v
+    d[k] = d.get(k, 0) + v
 
 
 def delete_or_decrement(d, k, v=1, delete_on=1):
@@ -215,11 +236,16 @@ def remove_duplicates(li):
     @return: a copy of the list with some elements potentially removed
     @rtype: L{list}
     """
-    ret = []
-    for e in li:
-        if e not in ret:
-            ret.append(e)
-    return ret
+    try:
+        # dicts preserve the insertion order
+        return list(dict.fromkeys(li))
+    except TypeError:
+        # unhashable elements
+        ret = []
+        for e in li:
+            if e not in ret:
+                ret.append(e)
+        return ret
 
 
 def chunked(iterable, n):
@@ -233,16 +259,57 @@ def chunked(iterable, n):
     @return: a generator yielding lists, each a chunk of the input data
     @rtype: generator yielding L{list}
     """
-    current = []
-    for element in iterable:
-        current.append(element)
-        if len(current) >= n:
-            yield current
-            current = []
-    if current:
+    iterator = iter(iterable)
+    while True:
+        # islice fills the list without a python level loop
+        current = list(itertools.islice(iterator, n))
+        if not current:
+            break
         yield current
 
 
+def iter_in_background(iterable, chunk_size=1000, maxsize=BACKGROUND_QUEUE_SIZE):
+    """
+    Iterate over an iterable, consuming it in a background thread.
+
+    The elements are passed from the background thread in chunks via a
+    bounded queue, so at most maxsize chunks are produced ahead. This
+    allows e.g. reading and parsing a file while the elements are being
+    processed. Exceptions raised in the background thread are re-raised
+    when they are reached.
+
+    @param iterable: iterable to consume in the background
+    @type iterable: iterable
+    @param chunk_size: number of elements to pass at once
+    @type chunk_size: L{int}
+    @param maxsize: max number of chunks to produce ahead
+    @type maxsize: L{int}
+    @yields: the elements of the iterable, in order
+    @ytype: any
+    """
+    chunks = queue.Queue(maxsize=maxsize)
+
+    def _produce():
+        try:
+            for chunk in chunked(iterable, chunk_size):
+                chunks.put((chunk, None))
+        except BaseException as e:
+            chunks.put((None, e))
+        else:
+            chunks.put((None, None))
+
+    thread = threading.Thread(target=_produce, name="background-iterator", daemon=True)
+    thread.start()
+    while True:
+        chunk, exception = chunks.get()
+        if exception is not None:
+            raise exception
+        if chunk is None:
+            break
+        yield from chunk
+    thread.join()
+
+
 def get_urls_from_string(s):
     """
     Find all URLs in a string.
@@ -254,7 +321,43 @@ def get_urls_from_string(s):
     @return: a list of URLs
     @rtype: L{str}
     """
-    return [s[m.start():m.end()] for m in URL.finditer(s)]
+    return list(iter_urls_from_string(s))
+
+
+def iter_urls_from_string(s):
+    """
+    Iterate over all URLs in a string.
+
+    This is like L{get_urls_from_string}, but does not build a list.
+
+    @param s: string to search for URLs
+    @type s: L{str}
+    @return: a generator yielding the URLs
+    @rtype: generator yielding L{str}
+    """
+    if "http" not in s:
+        # fast path, every URL matched by the regex contains this
+        return
+    for m in URL.finditer(s):
+        yield m.group(0)
+
+
+def may_contain_reddit_urls(s):
+    """
+    Quickly check whether a string may contain reddit URLs.
+
+    This is a cheap check that can be used to skip extracting and
+    parsing the URLs of most strings. If this returns L{False}, no URL
+    in the string would be accepted by L{parse_reddit_url}.
+
+    @param s: string to check
+    @type s: L{str} or L{None}
+    @return: whether the string may contain reddit URLs
+    @rtype: L{bool}
+    """
+    if not s:
+        return False
+    return REDDIT_HOST.search(s) is not None
 
 
 def parse_reddit_url(url):
@@ -270,7 +373,8 @@ def parse_reddit_url(url):
     """
     if isinstance(url, bytes):
         url = url.decode("utf-8")
-    if url == "":
+    if not may_contain_reddit_urls(url):
+        # fast path, avoid parsing most non-reddit URLs
         return None
     parts = urlparse(url)
     host = parts.hostname
@@ -347,7 +451,8 @@ def trim_reddit_name(s):
     @return: the trimmed name
     @rtype: L{str}
     """
-    return ALLOWED_REDDIT_NAME_LETTERS.sub("", s).strip()
+    # the allowed letters do not include whitespace, no need to strip
+    return ALLOWED_REDDIT_NAME_LETTERS.sub("", s)
 
 
 def trim_title(s):
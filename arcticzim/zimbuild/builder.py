@@ -10,11 +10,12 @@ issues them their tasks and adds the result to the creator.
 @type MAX_RESULT_BACKLOG: L{int}
 @var POSTS_PER_TASK: number of post IDs to send per worker tasks
 @type POSTS_PER_TASK: L{int}
+@var MEDIAFILES_PER_QUERY: number of mediafiles to load at once when adding media
+@type MEDIAFILES_PER_QUERY: L{int}
 """
 import multiprocessing
 import threading
 import queue
-import datetime
 import time
 import os
 import contextlib
@@ -27,7 +28,7 @@ from scss.compiler import Compiler as ScssCompiler
 from scss.namespace import Namespace as ScssNamespace
 from scss.types import String as ScssString
 from sqlalchemy import select, func
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, load_only
 from libzim.writer import Creator, Item, StringProvider, FileProvider, Hint
 import tqdm
 
@@ -45,8 +46,9 @@ from ..util import format_timedelta, format_size, format_number, trim_title
 from ..downloader import hash_url
 from ..imgutils import mimetype_is_image, mimetype_is_video
 from ..db.models import Post, Subreddit, User, MediaFile, ARCTICZIM_USERNAME
-from .renderer import HtmlPage, Redirect, JsonObject, Script, FileReferences, RenderOptions
-from .worker import Worker, WorkerOptions
+from .renderer import HtmlPage, Redirect, JsonObject, Script, FileReferences
+from .worker import Worker
+from .options import BuildOptions, get_n_cores, DEFAULT_FETCH_SIZE  # noqa: F401
 from .worker import StopTask, PostRenderTask, EtcRenderTask, SubredditRenderTask, UserRenderTask
 from .worker import MARKER_TASK_COMPLETED, MARKER_WORKER_STOPPED
 from .buckets import BucketMaker
@@ -55,26 +57,12 @@ from .buckets import BucketMaker
 MAX_OUTSTANDING_TASKS = 1024 * 8
 MAX_RESULT_BACKLOG = 1024
 POSTS_PER_TASK = 64
+MEDIAFILES_PER_QUERY = 500
 
 
 # =============== HELPER FUNCTIONS ================
 
 
-def get_n_cores():
-    """
-    Return the number of cores to use.
-    If multiprocessing is available, this is the number of cores available.
-    Otherwise, this will be 1.
-
-    @return: the number of cores to use.
-    @rtype: L{int}
-    """
-    if multiprocessing is not None:
-        return multiprocessing.cpu_count()
-    else:
-        return 1
-
-
 def config_process(name, nice=0, ionice=0):
     """
     Configure the current OS process.
@@ -412,360 +400,6 @@ class MediaItem(Item):
 # =============== BUILD LOGIC =================
 
 
-class BuildOptions(object):
-    """
-    A class containing the build options for the ZIM.
-
-    @ivar name: human-readable identifier of the resource
-    @type name: L{str}
-    @ivar title: title of ZIM file
-    @type title: L{str}
-    @ivar creator: creator of the ZIM file content
-    @type creator: L{str}
-    @ivar publisher: publisher of the ZIM file
-    @type publisher: L{str}
-    @ivar description: description of the ZIM file
-    @type description: L{str}
-    @ivar language: language to use (e.g. "eng")
-    @type language: L{str}
-    @ivar indexing: whether indexing should be enabled or not
-    @type indexing: L{bool}
-
-    @ivar with_stats: if nonzero, include statistics
-    @type with_stats: L{bool}
-    @ivar with_users: if nonzero, include user pages
-    @type with_users: L{bool}
-    @ivar with_media: if nonzero, include media files
-    @type with_media: L{str}
-    @ivar with_videos: if nonzero, include video files
-    @type with_videos: L{str}
-
-    @ivar use_threads: if nonzero, use threads instead of processes
-    @type use_threads: L{bool}
-    @ivar num_workers: number of (non-zim) workers to use
-    @type num_workers: L{int}
-    @ivar log_directory: if not None, enable logging and write logs into this directory
-    @type log_directory: L{str} or L{None}
-
-    @ivar eager: if nonzero, eager load objects from database
-    @type eager: L{bool}
-    @ivar memprofile_directory: if not None, enable memory profiling and write files into this directory
-    @type memprpofile_directory: L{str} or L{None}
-
-    @ivar skip_posts: debug option to not render posts
-    @type skip_posts: L{bool}
-    """
-    def __init__(
-        self,
-
-        # ZIM options
-        name="arcticzim_eng",
-        title="ArcticZim",
-        creator="Reddit and ArcticShift",
-        publisher="ArcticZim",
-        description="ZIM file containing a part of reddit",
-        language="eng",
-        indexing=True,
-
-        # content options
-        with_stats=True,
-        with_users=True,
-        with_media=True,
-        with_videos=False,
-
-        # genral build_options
-        log_directory=None,
-
-        # worker management options
-        use_threads=False,
-        num_workers=None,
-
-        # worker options
-        eager=True,
-        memprofile_directory=None,
-
-        # debug options
-        skip_posts=False,
-    ):
-        """
-        The default constructor.
-
-        @param name: human-readable identifier of the resource
-        @type name: L{str}
-        @param title: title of ZIM file
-        @type title: L{str}
-        @param creator: creator of the ZIM file content
-        @type creator: L{str}
-        @param publisher: publisher of the ZIM file
-        @type publisher: L{str}
-        @param description: description of the ZIM file
-        @type description: L{str}
-        @param language: language to use (e.g. "eng")
-        @type language: L{str}
-        @param indexing: whether indexing should be enabled or not
-        @type indexing: L{bool}
-
-        @param use_threads: if nonzero, use threads instead of processes
-        @type use_threads: L{bool}
-        @param num_workers: number of (non-zim) workers to use (None -> auto)
-        @type num_workers: L{int} or L{None}
-
-        @param log_directory: if specified, enable logging and write logs into this directory
-        @type log_directory: L{str} or L{None}
-
-        @param eager: if nonzero, eager load objects from database
-        @type eager: L{bool}
-        @param memprofile_directory: if specified, enable memory profiling and write files into this directory
-        @type memprofile_directory: L{str} or L{None}
-
-        @param skip_posts: debug option to not render posts
-        @type skip_posts: L{bool}
-        @param with_stats: if nonzero, include statistics
-        @type with_stats: L{bool}
-        @param with_users: if nonzero, include user pages
-        @type with_users: L{bool}
-        @param with_media: if nonzero, include media files
-        @type with_media: L{str}
-        @param with_videos: if nonzero, include video files
-        @type with_videos: L{str}
-        """
-        self.name = name
-        self.title = title
-        self.creator = creator
-        self.publisher = publisher
-        self.description = description
-        self.language = language
-        self.indexing = indexing
-
-        self.with_stats = with_stats
-        self.with_users = with_users
-        self.with_media = with_media
-        self.with_videos = with_videos
-
-        self.use_threads = bool(use_threads)
-        if num_workers is None:
-            self.num_workers = get_n_cores()
-        else:
-            self.num_workers = int(num_workers)
-
-        self.log_directory = log_directory
-
-        self.eager = eager
-        self.memprofile_directory = memprofile_directory
-
-        self.skip_posts = skip_posts
-
-    @staticmethod
-    def add_argparse_options(parser):
-        """
-        Add all CLI options to the specified argparse parser.
-
-        @param parser: argument parser to which to add the arguments
-        @type parser: L{argparse.ArgumentParser}
-        """
-        parser.add_argument(
-            "--name",
-            action="store",
-            dest="name",
-            default="arcticzim_eng",
-            help="a human readable identifier for the ZIM",
-        )
-        parser.add_argument(
-            "--title",
-            action="store",
-            dest="title",
-            default="ArcticZim",
-            help="the title of the ZIM file",
-        )
-        parser.add_argument(
-            "--creator",
-            action="store",
-            dest="creator",
-            default="Reddit and Arctic Shift",
-            help="creator(s) of the ZIM file content",
-        )
-        parser.add_argument(
-            "--publisher",
-            action="store",
-            dest="publisher",
-            default="ArcticZim",
-            help="creator of the ZIM file itself",
-        )
-        parser.add_argument(
-            "--description",
-            action="store",
-            dest="description",
-            default="A ZIM file containing a part of reddit",
-            help="a short description of the content",
-        )
-        parser.add_argument(
-            "--language",
-            action="store",
-            dest="language",
-            default="eng",
-            help="ISO639-3 language identifier describing content language",
-        )
-        parser.add_argument(
-            "--no-indexing",
-            action="store_false",
-            dest="indexing",
-            help="disable indexing of ZIM",
-        )
-
-        parser.add_argument(
-            "--threaded",
-            action="store_true",
-            help="use threads instead of processes for workers"
-        )
-        parser.add_argument(
-            "--workers",
-            action="store",
-            type=int,
-            default=None,
-            help="use this many non-zim workers",
-        )
-        parser.add_argument(
-            "--log-directory",
-            action="store",
-            default=None,
-            help="enable logging and write logs into this directory",
-        )
-        parser.add_argument(
-            "--no-stats",
-            action="store_false",
-            dest="with_stats",
-            help="do not include statistics",
-        )
-        parser.add_argument(
-            "--no-media",
-            action="store_false",
-            dest="with_media",
-            help="do not include media",
-        )
-        parser.add_argument(
-            "--with-videos",
-            action="store_true",
-            dest="with_videos",
-            help="include videos",
-        )
-        parser.add_argument(
-            "--no-users",
-            action="store_false",
-            dest="with_users",
-            help="do not include user pages",
-        )
-        parser.add_argument(
-            "--lazy",
-            action="store_false",
-            dest="eager",
-            help="Do not eager load related objects, ...",
-        )
-        parser.add_argument(
-            "--memprofile-directory",
-            action="store",
-            default=None,
-            help="enable memory profile and write into this directory",
-        )
-        parser.add_argument(
-            "--debug-skip-posts",
-            action="store_true",
-            dest="skip_posts",
-            help="do not include posts (debug option)",
-        )
-
-    @classmethod
-    def from_ns(cls, ns):
-        """
-        Instantiate build options from a namespace returned by a parser.
-        This method assumes that the parser was preprared using L{BuildOptions.add_argparse_options}.
-
-        @param ns: namespace containg the arguments
-        @type ns: L{argparse.Namespace}
-        """
-        bo = cls(
-            name=ns.name,
-            title=ns.title,
-            creator=ns.creator,
-            publisher=ns.publisher,
-            description=ns.description,
-            language=ns.language,
-            indexing=ns.indexing,
-
-            use_threads=ns.threaded,
-            num_workers=ns.workers,
-            log_directory=ns.log_directory,
-            eager=ns.eager,
-            memprofile_directory=ns.memprofile_directory,
-
-            with_stats=ns.with_stats,
-            with_users=ns.with_users,
-            with_media=ns.with_media,
-            with_videos=ns.with_videos,
-            skip_posts=ns.skip_posts,
-        )
-        return bo
-
-    def get_metadata_dict(self):
-        """
-        Return a dictionary encoding the ZIM metadata described by this file.
-
-        Additional metadata will likely be added.
-
-        @return: a dictionary containing the metadata of this ZIM file.
-        @rtype: L{bool}
-        """
-        tags = [
-            "_sw:no",
-            "_ftindex:" + ("yes" if self.indexing else "no"),
-            "_pictures:" + ("yes" if self.with_media else "no"),
-            "_videos:" + ("yes" if self.with_videos else "no"),
-            "_category:reddit",
-        ]
-        metadata = {
-            "Name": self.name,
-            "Title": self.title,
-            "Creator": self.creator,
-            "Date": datetime.date.today().isoformat(),
-            "Publisher": self.publisher,
-            "Description": self.description,
-            "Language": self.language,
-            "Tags": ";".join(tags),
-            "Scraper": "arcticzim",
-        }
-        return metadata
-
-    def get_worker_options(self):
-        """
-        Return the worker options the worker should use.
-
-        @return: options for the worker.
-        @rtype: L{arcticzim.zimbuild.worker.WorkerOptions}
-        """
-        options = WorkerOptions(
-            eager=self.eager,
-            memprofile_directory=self.memprofile_directory,
-            log_directory=self.log_directory,
-            with_stats=self.with_stats,
-            with_media=self.with_media,
-            with_videos=self.with_videos,
-        )
-        return options
-
-    def get_render_options(self):
-        """
-        Return the render options the renderer should use.
-
-        @return: options for the renderer
-        @rtype: L{arcticzim.zimbuild.renderer.RenderOptions}
-        """
-        options = RenderOptions(
-            with_stats=self.with_stats,
-            with_users=self.with_users,
-            with_videos=self.with_videos,
-        )
-        return options
-
-
 class ZimBuilder(object):
     """
     The ZimBuilder manages the ZIM build process.
@@ -996,7 +630,7 @@ class ZimBuilder(object):
             task_multiplier=(1 / n_tasks_per_subreddit),
             task_unit="subreddits",
         ):
-            self._send_subreddit_tasks(session, with_stats=options.with_stats)
+            self._send_subreddit_tasks(session, with_stats=options.with_stats, fetch_size=options.fetch_size)
         # --- users ---
         if options.with_users:
             self.log(" -> Adding users...")
@@ -1017,7 +651,7 @@ class ZimBuilder(object):
                 task_multiplier=(1 / n_tasks_per_user),
                 task_unit="users",
             ):
-                self._send_user_tasks(session, with_stats=options.with_stats)
+                self._send_user_tasks(session, with_stats=options.with_stats, fetch_size=options.fetch_size)
         else:
             self.log(" -> Skipping users!")
         # --- posts ---
@@ -1037,7 +671,7 @@ class ZimBuilder(object):
                 task_unit="posts",
                 task_multiplier=POSTS_PER_TASK,
             ):
-                self._send_post_tasks(session)
+                self._send_post_tasks(session, fetch_size=options.fetch_size)
         else:
             self.log(" -> Skipping posts!")
         # --- media ---
@@ -1046,18 +680,26 @@ class ZimBuilder(object):
             n = len(self.media_file_references)
             with tqdm.tqdm(desc="Adding files", total=n, unit="files") as bar:
                 while self.media_file_references:
-                    uid = self.media_file_references.pop()
-                    stmt = select(MediaFile).where(MediaFile.uid == uid)
-                    mf = session.execute(stmt).one()[0]
-                    item = MediaItem(self.mediadir, mf)
-                    creator.add_item(item)
-                    if mimetype_is_image(mf.mimetype):
-                        set_or_increment(self.num_files_added, "image", 1)
-                    elif mimetype_is_video(mf.mimetype):
-                        set_or_increment(self.num_files_added, "video", 1)
-                    else:
-                        set_or_increment(self.num_files_added, "other media", 1)
-                    bar.update(1)
+                    # load the mediafiles in batches instead of one query per file
+                    uids = [
+                        self.media_file_references.pop()
+                        for i in range(min(MEDIAFILES_PER_QUERY, len(self.media_file_references)))
+                    ]
+                    stmt = select(MediaFile).where(
+                        MediaFile.uid.in_(uids),
+                    ).options(
+                        load_only(MediaFile.uid, MediaFile.url, MediaFile.mimetype),
+                    )
+                    for mf in session.execute(stmt).scalars():
+                        item = MediaItem(self.mediadir, mf)
+                        creator.add_item(item)
+                        if mimetype_is_image(mf.mimetype):
+                            set_or_increment(self.num_files_added, "image", 1)
+                        elif mimetype_is_video(mf.mimetype):
+                            set_or_increment(self.num_files_added, "video", 1)
+                        else:
+                            set_or_increment(self.num_files_added, "other media", 1)
+                    bar.update(len(uids))
         else:
             self.log(" -> Skipping media!")
 
@@ -1242,7 +884,7 @@ class ZimBuilder(object):
                             raise RuntimeError("Unknown render result: {}".format(type(rendered_object)))
                         set_or_increment(self.num_files_added, "total")
                         n_items_added += 1
-                        bar.set_postfix({"items": n_items_added})
+                        bar.set_postfix({"items": n_items_added}, refresh=False)
 
     def _worker_process(self, id, connection_config, worker_options, render_options):
         """
@@ -1273,15 +915,17 @@ class ZimBuilder(object):
         )
         worker.run()
 
-    def _send_post_tasks(self, session):
+    def _send_post_tasks(self, session, fetch_size=DEFAULT_FETCH_SIZE):
         """
         Create and send the tasks for the posts to the worker inqueue.
 
         @param session: sqlalchemy session for data querying
         @type session: L{sqlalchemy.orm.Session}
+        @param fetch_size: number of rows to fetch at once
+        @type fetch_size: L{int}
         """
         post_bucket_maker = BucketMaker(maxsize=POSTS_PER_TASK)
-        select_post_ids_stmt = select(Post.uid)
+        select_post_ids_stmt = select(Post.uid).execution_options(yield_per=fetch_size)
         result = session.execute(select_post_ids_stmt)
         # create buckets and turn them into tasks
         for post in result:
@@ -1296,7 +940,7 @@ class ZimBuilder(object):
             task = PostRenderTask(bucket)
             self.inqueue.put(task)
 
-    def _send_subreddit_tasks(self, session, with_stats=True):
+    def _send_subreddit_tasks(self, session, with_stats=True, fetch_size=DEFAULT_FETCH_SIZE):
         """
         Create and send the tasks for the subreddits to the worker inqueue.
 
@@ -1304,8 +948,10 @@ class ZimBuilder(object):
         @type session: L{sqlalchemy.orm.Session}
         @param with_stats: if nonzero, include stats
         @type with_stats: L{bool}
+        @param fetch_size: number of rows to fetch at once
+        @type fetch_size: L{int}
         """
-        select_subreddit_names_stmt = select(Subreddit.name)
+        select_subreddit_names_stmt = select(Subreddit.name).execution_options(yield_per=fetch_size)
         result = session.execute(select_subreddit_names_stmt)
         subtasks = ["top", "new", "wiki", "rules"]
         if with_stats:
@@ -1316,7 +962,7 @@ class ZimBuilder(object):
                 task = SubredditRenderTask(subreddit_name=subreddit.name, subtask=subtask)
                 self.inqueue.put(task)
 
-    def _send_user_tasks(self, session, with_stats=True):
+    def _send_user_tasks(self, session, with_stats=True, fetch_size=DEFAULT_FETCH_SIZE):
         """
         Create and send the tasks for the users to the worker inqueue.
 
@@ -1324,8 +970,14 @@ class ZimBuilder(object):
         @type session: L{sqlalchemy.orm.Session}
         @param with_stats: if nonzero, include stats
         @type with_stats: L{bool}
+        @param fetch_size: number of rows to fetch at once
+        @type fetch_size: L{int}
         """
-        select_usernames_stmt = select(User.name).where(User.name != ARCTICZIM_USERNAME)
+        select_usernames_stmt = (
+            select(User.name)
+            .where(User.name != ARCTICZIM_USERNAME)
+            .execution_options(yield_per=fetch_size)
+        )
         result = session.execute(select_usernames_stmt)
         # send out tasks
         for user in result:
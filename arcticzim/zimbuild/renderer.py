@@ -29,7 +29,7 @@ except ImportError:
 
 from ..util import format_size, format_number, get_resource_file_path, parse_reddit_url
 from ..util import timestamp_to_date_triplet
-from ..downloader import MediaFileManager
+from ..downloader import MediaFileManager, get_urls_from_post
 from .buckets import BucketMaker
 from .custommistune import CustomMistuneBlockLevelParser, relative_url_plugin
 
@@ -440,7 +440,7 @@ class HtmlRenderer(object):
         @param result: result to add file references to
         @type result: L{RenderResult}
         """
-        fro = FileReferences(list(set(self.filemanager.referenced_files)))
+        fro = FileReferences(list(self.filemanager.referenced_files))
         result.add(fro)
 
     def render_post(self, post):
@@ -453,6 +453,17 @@ class HtmlRenderer(object):
         @rtype: L{RenderResult}
         """
         self.filemanager.reset()
+        if self.filemanager.enabled:
+            # resolve the media of the post and its comments in a single query
+            urls = get_urls_from_post(
+                post,
+                include_reddit_videos=self.filemanager.videos_enabled,
+                include_external_videos=self.filemanager.videos_enabled,
+                include_comments=True,
+            )
+            if post.url:
+                urls.append(post.url)
+            self.filemanager.warm_up(urls)
         result = RenderResult()
         post_template = self.environment.get_template("postpage.html.jinja")
         post_page = post_template.render(
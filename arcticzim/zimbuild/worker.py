@@ -13,8 +13,6 @@ take the results and add them to the creator.
 
 @var MAX_POST_EAGERLOAD: when loading subreddits, do not eagerload if more than this number of posts are in said object
 @type MAX_POST_EAGERLOAD: L{int}
-@var POST_LIST_YIELD: number of story to fetch at once when rendering posts, ...
-@type POST_LIST_YIELD: L{int}
 """
 import contextlib
 import os
@@ -31,6 +29,7 @@ except ImportError:
 
 from .renderer import HtmlRenderer, RenderResult, SubredditInfo, SUBREDDITS_ON_INDEX_PAGE
 from .statistics import query_post_stats
+from .options import DEFAULT_FETCH_SIZE
 from ..util import ensure_iterable
 from ..downloader import MediaFileManager
 from ..fetcher import ReferenceUrlRewriter
@@ -44,8 +43,6 @@ MAX_POST_EAGERLOAD = 10000
 MIN_POSTS_FOR_EXPLICIT_STATS = 10000
 MIN_POSTS_FOR_STREAM = 10000
 
-POST_LIST_YIELD = 2000
-
 
 class Task(object):
     """
@@ -211,6 +208,8 @@ class WorkerOptions(object):
 
     @ivar eager: eager load objects from database
     @type eager: L{bool}
+    @ivar fetch_size: number of rows to fetch at once when streaming large query results
+    @type fetch_size: L{int}
     @ivar log_directory: if not None, enable logging and write log here
     @type log_directory: L{str} or L{None}
     @ivar memprofile_directory: if not None, profile memory usage and write files into this directory
@@ -225,6 +224,7 @@ class WorkerOptions(object):
     def __init__(
         self,
         eager=True,
+        fetch_size=DEFAULT_FETCH_SIZE,
         log_directory=None,
         memprofile_directory=None,
 
@@ -237,6 +237,8 @@ class WorkerOptions(object):
 
         @param eager: if nonzero, eager load objects from database
         @type eager: L{bool}
+        @param fetch_size: number of rows to fetch at once when streaming large query results
+        @type fetch_size: L{int}
         @param log_directory: if specified, enable logging and write log here
         @type log_directory: L{str} or L{None}
         @param memprofile_directory: if specified, profile memory usage and write files into this directory
@@ -251,6 +253,7 @@ class WorkerOptions(object):
         assert isinstance(log_directory, str) or (log_directory is None)
         assert isinstance(memprofile_directory, str) or (memprofile_directory is None)
         self.eager = eager
+        self.fetch_size = fetch_size
         self.log_directory = log_directory
         self.memprofile_directory = memprofile_directory
         self.with_stats = with_stats
@@ -604,7 +607,7 @@ class Worker(object):
         )
         execution_options = {}
         if n_posts_in_subreddit >= MIN_POSTS_FOR_STREAM:
-            execution_options["yield_per"] = POST_LIST_YIELD
+            execution_options["yield_per"] = self.options.fetch_size
         post_stmt = (
             select(Post)
             .where(
@@ -855,7 +858,7 @@ class Worker(object):
         )
         execution_options = {}
         if n_posts_by_user >= MIN_POSTS_FOR_STREAM:
-            execution_options["yield_per"] = POST_LIST_YIELD
+            execution_options["yield_per"] = self.options.fetch_size
         post_stmt = (
             select(Post)
             .where(
@@ -944,7 +947,7 @@ class Worker(object):
         )
         execution_options = {}
         if n_comments_by_user >= MIN_POSTS_FOR_STREAM:
-            execution_options["yield_per"] = POST_LIST_YIELD
+            execution_options["yield_per"] = self.options.fetch_size
         comment_stmt = (
             select(Comment)
             .where(
@@ -0,0 +1,142 @@
+"""
+Tests for L{arcticzim.importer}.
+"""
+import multiprocessing
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from arcticzim.db.connection import ConnectionConfig, init_schema
+from arcticzim.db.models import Post, Comment, User, Subreddit
+from arcticzim.importer import prepare_db, import_posts_from_file
+from arcticzim.jsonl import write_jsonl
+
+
+def make_post(i, subreddit="testsub", subscribers=10, author="testuser"):
+    """
+    Generate a dataset post.
+
+    @param i: number of the post, used to generate the ids
+    @type i: L{int}
+    @param subreddit: name of the subreddit of the post
+    @type subreddit: L{str}
+    @param subscribers: number of subscribers of the subreddit
+    @type subscribers: L{int}
+    @param author: name of the author of the post
+    @type author: L{str}
+    @return: the post as it would appear in the dataset
+    @rtype: L{dict}
+    """
+    postid = "p{}".format(i)
+    return {
+        "id": postid,
+        "name": "t3_" + postid,
+        "author": author,
+        "author_created_utc": 1600000000,
+        "subreddit": subreddit,
+        "subreddit_id": "t5_test",
+        "subreddit_subscribers": subscribers,
+        "created_utc": 1700000000 + i,
+        "edited": False,
+        "is_self": True,
+        "num_comments": 0,
+        "over_18": False,
+        "permalink": "/r/{}/comments/{}/".format(subreddit, postid),
+        "score": i,
+        "selftext": "Text of post {}".format(i),
+        "spoiler": False,
+        "title": "Post {} &amp; more".format(i),
+        "ups": i,
+        "upvote_ratio": 1,
+        "url": "https://www.reddit.com/r/{}/comments/{}/".format(subreddit, postid),
+    }
+
+
+def import_posts_into_sqlite(tmp_path, posts, pool=None, batch_size=2):
+    """
+    Import posts into a new sqlite database, returning the imported data.
+
+    @param tmp_path: directory to create the files in
+    @type tmp_path: L{pathlib.Path}
+    @param posts: dataset posts to import
+    @type posts: L{list} of L{dict}
+    @param pool: if specified, parse the file using this pool
+    @type pool: L{multiprocessing.pool.Pool} or L{None}
+    @param batch_size: how many posts to import at once
+    @type batch_size: L{int}
+    @return: a tuple of (posts, subreddits, users, number of comments)
+    @rtype: L{tuple}
+    """
+    path = str(tmp_path / "posts.jsonl")
+    write_jsonl(path, posts)
+    engine = ConnectionConfig("sqlite:///{}".format(tmp_path / "test.db")).connect()
+    init_schema(engine)
+    with Session(engine) as session:
+        prepare_db(session)
+        import_posts_from_file(session, path, batch_size=batch_size, pool=pool)
+        imported_posts = session.execute(
+            select(Post.id, Post.author_name, Post.subreddit_name, Post.title, Post.selftext).order_by(Post.id),
+        ).all()
+        subreddits = dict(session.execute(select(Subreddit.name, Subreddit.subscribers)).all())
+        users = set(session.execute(select(User.name)).scalars())
+        n_comments = len(session.execute(select(Comment.uid)).all())
+    engine.dispose()
+    return ([tuple(row) for row in imported_posts], subreddits, users, n_comments)
+
+
+def get_test_posts():
+    """
+    Return the posts used by the import tests.
+
+    The subreddits appear in multiple batches with increasing
+    subscriber counts, so that existing subreddits are updated.
+
+    @return: the dataset posts
+    @rtype: L{list} of L{dict}
+    """
+    return [
+        make_post(1, subscribers=10),
+        make_post(2, subreddit="othersub", subscribers=5, author="otheruser"),
+        make_post(3, subscribers=20),
+        make_post(4, subscribers=15),
+        make_post(5, subreddit="othersub", subscribers=7),
+    ]
+
+
+def test_import_posts_from_file(tmp_path):
+    """
+    Test importing posts from a file into a sqlite database.
+    """
+    posts, subreddits, users, n_comments = import_posts_into_sqlite(tmp_path, get_test_posts())
+    assert [row[0] for row in posts] == ["p1", "p2", "p3", "p4", "p5"]
+    assert posts[1][1:3] == ("otheruser", "othersub")
+    assert posts[0][3] == "Post 1 &amp; more"
+    assert posts[0][4] == "Text of post 1"
+    assert subreddits == {"testsub": 20, "othersub": 7}
+    assert {"testuser", "otheruser"}.issubset(users)
+    # one root comment per post
+    assert n_comments == 5
+
+
+def test_import_posts_from_file_with_pool(tmp_path):
+    """
+    Test that importing posts using a parser pool yields the same data.
+    """
+    (tmp_path / "serial").mkdir()
+    (tmp_path / "parallel").mkdir()
+    expected = import_posts_into_sqlite(tmp_path / "serial", get_test_posts())
+    with multiprocessing.Pool(3) as pool:
+        result = import_posts_into_sqlite(tmp_path / "parallel", get_test_posts(), pool=pool)
+    assert result == expected
+
+
+@pytest.mark.parametrize("batch_size", [1, 1000])
+def test_import_posts_batch_size(tmp_path, batch_size):
+    """
+    Test that the batch size does not change the imported data.
+    """
+    posts, subreddits, users, n_comments = import_posts_into_sqlite(tmp_path, get_test_posts(), batch_size=batch_size)
+    assert len(posts) == 5
+    assert subreddits == {"testsub": 20, "othersub": 7}
+    assert n_comments == 5